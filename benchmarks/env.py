@@ -0,0 +1,162 @@
+"""
+Benchmark of converting a Dockerfile with hundreds of ENV instructions (and
+RUNs that use them): the Environment symbol table against regex findall and
+str.replace on every line with a char by char ENV parser (which is what
+Docker.ENV and Docker.put_together used to do)
+
+Usage: python benchmarks/env.py [--envs <envs>] [--runs <runs>]
+"""
+import argparse
+import os.path
+import re
+import sys
+import tempfile
+import time
+
+argparser = argparse.ArgumentParser(description='ENV expansion benchmark')
+argparser.add_argument(
+    '--envs', default=500, type=int, metavar='<envs>',
+    help='ENV instructions in the Dockerfile; *Default: 500')
+argparser.add_argument(
+    '--runs', default=500, type=int, metavar='<runs>',
+    help='RUN instructions in the Dockerfile; *Default: 500')
+argparser.add_argument(
+    '--repeat', default=5, type=int, metavar='<repeat>',
+    help='Conversions to time (the best one is reported); *Default: 5')
+args = vars(argparser.parse_args())
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from undockerize.undockerize import Docker, Task, env_references  # NOQA
+
+
+class OldEnvDocker(Docker):
+    """
+    Docker with the old ENV handling
+    """
+    def __init__(self, file_name, dir_str):
+        Docker.__init__(self, file_name, dir_str)
+        self.all_env_vars = {}
+
+    def find_env_vars(self, cmd):
+        return re.findall(r'[$]([a-zA-Z0-9_]+)', cmd)
+
+    def ENV(self, instruction):
+        env_vars = self.ENV_helper(instruction.args)
+        _vars, _vals = self.ENV_parser(env_vars)
+        for x in range(0, len(_vars)):
+            for _var in self.find_env_vars(_vals[x]):
+                val_of_other_var = self.all_env_vars.get(_var)
+                if val_of_other_var is not None:
+                    _vals[x] = _vals[x].replace('$' + _var, val_of_other_var)
+            self.all_env_vars[_vars[x]] = _vals[x]
+        regex = r'([a-zA-Z0-9_]+)=(?=(?:[^"]*"[^"]*")*[^"]*$)'
+        name = 'Set ENV vars- ' + ' '.join(re.findall(regex, env_vars))
+        task = Task(name, 'lineinfile',
+                    {'dest': '~/.bashrc', 'line': 'export ' + env_vars})
+        self.put_together('ENV', task)
+
+    def ENV_parser(self, env_vars):
+        env_vars += ' '
+        open_quote = False
+        last_backslash = False
+        is_var = True
+        _vars = []
+        _vals = []
+        word = ''
+        for char in env_vars:
+            if is_var and char == '=':
+                _vars.append(word)
+                word = ''
+                is_var = False
+            elif is_var and char != ' ':
+                word += char
+            elif is_var:
+                continue
+            elif char == '"':
+                open_quote = not open_quote
+                if open_quote is False:
+                    _vals.append(word)
+                    word = ''
+                    is_var = True
+            elif open_quote:
+                word += char
+            elif char == '\\' and not last_backslash:
+                last_backslash = True
+            elif last_backslash:
+                word += char
+                last_backslash = False
+            elif char == ' ':
+                _vals.append(word)
+                word = ''
+                is_var = True
+            else:
+                word += char
+        return _vars, _vals
+
+    def put_together(self, _type, task):
+        task.comments = list(self.current_comments)
+        del self.current_comments[:]
+        if _type != 'ENV':
+            for line in task.strings():
+                for _var in self.find_env_vars(line):
+                    _val = self.all_env_vars.get(_var)
+                    if _val is not None and _var not in task.environment:
+                        if '~' in _val:
+                            _val = '{{ "' + _val + '" | expanduser }}'
+                        task.environment[_var] = _val
+        self.ansible_file.append(task)
+
+
+def make_dockerfile(f, envs, runs):
+    """
+    Writes a Dockerfile where every ENV sets a few vars that use the ENVs
+    before it and every RUN uses a few of the ENVs
+    """
+    f.write('FROM debian:jessie\n')
+    f.write('ENV ROOT=/opt\n')
+    for x in range(envs):
+        f.write('ENV VAR_%d=$ROOT/dir_%d NAME_%d="$VAR_%d v%d" \\\n'
+                '    URL_%d=https://example.com/releases/v%d/'
+                'pkg-%d.tar.gz \\\n'
+                '    SHA_%d=%064x\n'
+                % (x, x, x, max(x - 1, 0), x, x, x, x, x, x))
+    for x in range(runs):
+        f.write('RUN cd $VAR_%d && curl -fsSL $URL_%d | tar -xz && '
+                'make NAME=$NAME_%d install PREFIX=$VAR_%d\n'
+                % (x % envs, x % envs, (x * 7) % envs, (x * 13) % envs))
+
+
+def best_time(cls, file_name):
+    """
+    Returns the fastest of the conversions of file_name and the tasks
+    """
+    times = []
+    for _ in range(args['repeat']):
+        docker = cls(file_name, '.')
+        env_references.cache_clear()  # not warmed up by the last run
+        start = time.perf_counter()
+        docker.parse_docker()
+        times.append(time.perf_counter() - start)
+    return min(times), docker.ansible_file
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'Dockerfile')
+        with open(file_name, 'w') as f:
+            make_dockerfile(f, args['envs'], args['runs'])
+        print('%d ENVs, %d RUNs' % (args['envs'], args['runs']))
+
+        new_time, new_tasks = best_time(Docker, file_name)
+        old_time, old_tasks = best_time(OldEnvDocker, file_name)
+        print('%-22s %9.3f ms' % ('symbol table', new_time * 1000))
+        print('%-22s %9.3f ms' % ('findall and replace', old_time * 1000))
+        # the old way also used the vars an ENV sets in the ENV itself
+        same = sum(new.environment == old.environment
+                   for new, old in zip(new_tasks, old_tasks))
+        print('%d of %d tasks have the same environment' % (
+            same, len(new_tasks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Synthetic inputs for the benchmarks: Dockerfiles of any size, an
+official-images library and bare docker-library repos in a local directory
+(for --git-base), so that nothing gets fetched from the network
+"""
+import os.path
+import subprocess
+
+
+def git(repo_dir, *git_args):
+    """
+    Runs git quietly in repo_dir
+    """
+    subprocess.check_call(['git', '-C', repo_dir] + list(git_args),
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+
+
+def commit_all(repo_dir):
+    """
+    Makes repo_dir a git repo with everything in it committed
+    """
+    git(repo_dir, 'init', '-q')
+    git(repo_dir, 'add', '-A')
+    git(repo_dir, '-c', 'user.name=bench',
+        '-c', 'user.email=bench@example.com',
+        'commit', '-qm', 'fixture')
+
+
+def make_dockerfile(f, runs=100, envs=100, copies=20, continuation=20,
+                    base='debian:stable'):
+    """
+    Writes a Dockerfile with runs RUNs (every 10th one continued over
+    continuation lines), envs ENVs (that use the ENVs before them), copies
+    COPYs and as many bracket form ADDs
+    """
+    f.write('FROM ' + base + '\n')
+    f.write('ENV ROOT=/opt\n')
+    for x in range(envs):
+        f.write('ENV VAR_%d=$ROOT/dir_%d NAME_%d="v %d"\n' % (x, x, x, x))
+    for x in range(copies):
+        f.write('COPY file_%d.txt conf_%d.ini $ROOT/etc_%d/\n' % (x, x, x))
+        f.write('ADD ["dir %d/a file", "other_%d.txt", "/srv/%d/"]\n'
+                % (x, x, x))
+    for x in range(runs):
+        var = x % max(envs, 1)
+        if x % 10 == 0:
+            f.write('# build step %d\n' % x)
+            f.write('RUN set -e; \\\n')
+            for y in range(continuation):
+                f.write('    echo "step %d.%d" >> $VAR_%d/log && \\\n'
+                        % (x, y, var))
+            f.write('    true\n')
+        else:
+            f.write('RUN cd $VAR_%d && make NAME=$NAME_%d install\n'
+                    % (var, var))
+    f.write('WORKDIR $ROOT\n')
+    f.write('CMD ["/bin/sh"]\n')
+
+
+def make_context(context_dir, copies=20):
+    """
+    Makes the files that the COPYs and ADDs of make_dockerfile use in
+    context_dir
+    """
+    for x in range(copies):
+        os.makedirs(os.path.join(context_dir, 'dir %d' % x), exist_ok=True)
+        for name in ('file_%d.txt' % x, 'conf_%d.ini' % x,
+                     'dir %d/a file' % x, 'other_%d.txt' % x):
+            with open(os.path.join(context_dir, name), 'w') as f:
+                f.write('%s\n' % name * 64)
+
+
+def make_library_file(f, repo, entries):
+    """
+    Writes a library file of repo with entries paragraphs (tags x.y.1 and
+    x.y, x.y-jessie... in the Directory x.y/jessie)
+    """
+    f.write('Maintainers: Foo <foo@example.com> (@foo),\n')
+    f.write('             Bar <bar@example.com> (@bar)\n')
+    f.write('GitRepo: https://github.com/docker-library/%s.git\n' % repo)
+    for y in range(entries):
+        f.write('\nTags: %d.1-jessie, %d-jessie\n' % (y, y))
+        f.write('SharedTags: %d.1, %d\n' % (y, y))
+        f.write('Architectures: amd64, arm32v7, arm64v8, i386\n')
+        f.write('GitCommit: %040x\n' % y)
+        f.write('Directory: %d/jessie\n' % y)
+
+
+def make_remote(remote_dir, depth, extra_repos=0, entries=20):
+    """
+    Makes bare repos in remote_dir: one for each of depth images, where
+    image<n>:1.0 is FROM image<n-1>:1.0 and image0 is FROM debian:stable
+    (which has no repo), and official-images with their library files
+    (plus extra_repos library files with entries paragraphs that don't
+    have repos, so the library isn't tiny)
+    Returns the image at the top of the chain
+    """
+    work_dir = os.path.join(remote_dir, 'work')
+    library_dir = os.path.join(work_dir, 'official-images', 'library')
+    os.makedirs(library_dir)
+    for x in range(depth):
+        repo = 'image%d' % x
+        repo_dir = os.path.join(work_dir, repo)
+        image_dir = os.path.join(repo_dir, '1.0')
+        os.makedirs(image_dir)
+        base = 'debian:stable' if x == 0 else 'image%d:1.0' % (x - 1)
+        with open(os.path.join(image_dir, 'Dockerfile'), 'w') as f:
+            make_dockerfile(f, runs=30, envs=10, copies=2, continuation=5,
+                            base=base)
+        make_context(image_dir, copies=2)
+        commit_all(repo_dir)
+        with open(os.path.join(library_dir, repo), 'w') as f:
+            f.write('GitRepo: https://github.com/docker-library/%s.git\n\n'
+                    % repo)
+            f.write('Tags: 1.0\nArchitectures: amd64\nGitCommit: %040x\n'
+                    'Directory: 1.0\n' % x)
+    for x in range(extra_repos):
+        with open(os.path.join(library_dir, 'extra%d' % x), 'w') as f:
+            make_library_file(f, 'extra%d' % x, entries)
+    commit_all(os.path.dirname(library_dir))
+
+    for repo in os.listdir(work_dir):
+        subprocess.check_call(
+            ['git', 'clone', '-q', '--bare', os.path.join(work_dir, repo),
+             os.path.join(remote_dir, repo + '.git')],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return 'image%d:1.0' % (depth - 1)
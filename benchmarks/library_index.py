@@ -0,0 +1,124 @@
+"""
+Benchmark of looking up the Directory of every tag in an official-images
+library: the LibraryIndex against scanning the library file for each tag
+(which is what get_repo_dir_from_docker_lib used to do)
+
+Usage: python benchmarks/library_index.py [<official-images checkout>]
+Without a checkout a synthetic library is generated (and committed to a
+throwaway git repo, since saved indexes are named by the library commit)
+"""
+import argparse
+import os.path
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+argparser = argparse.ArgumentParser(description='Library lookup benchmark')
+argparser.add_argument(
+    'official_images', nargs='?', default=None, metavar='<official-images>',
+    help='Checkout of official-images; *Default: a synthetic library')
+argparser.add_argument(
+    '--repos', default=150, type=int, metavar='<repos>',
+    help='Repos in the synthetic library; *Default: 150')
+argparser.add_argument(
+    '--entries', default=40, type=int, metavar='<entries>',
+    help='Entries per repo in the synthetic library; *Default: 40')
+args = vars(argparser.parse_args())
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from undockerize.undockerize import LibraryIndex  # NOQA
+
+
+def make_library(library_dir, repos, entries):
+    """
+    Writes a synthetic library with entries paragraphs in each repo file
+    """
+    for x in range(repos):
+        with open(os.path.join(library_dir, 'repo%d' % x), 'w') as f:
+            f.write('Maintainers: Foo <foo@example.com> (@foo),\n')
+            f.write('             Bar <bar@example.com> (@bar)\n')
+            f.write('GitRepo: https://github.com/docker-library/repo%d.git'
+                    '\n' % x)
+            for y in range(entries):
+                f.write('\nTags: %d.%d.1-jessie, %d.%d-jessie\n' % (
+                    x, y, x, y))
+                f.write('SharedTags: %d.%d.1, %d.%d\n' % (x, y, x, y))
+                f.write('Architectures: amd64, arm32v7, arm64v8, i386\n')
+                f.write('GitCommit: %040x\n' % (x * entries + y))
+                f.write('Directory: %d.%d/jessie\n' % (x, y))
+
+
+def linear_lookup(library_dir, repo, tags):
+    """
+    The old lookup: scans the library file with a new regex every time
+    """
+    with open(os.path.join(library_dir, repo), 'r') as f:
+        found = False
+        for line in f:
+            if line.startswith('Tags:'):
+                regex_ret = re.findall(r' '+tags+'[ \n,]', line)
+                if len(regex_ret) > 0:
+                    found = True
+            if found and line.startswith('Directory:'):
+                return re.findall(r'Directory: (.*)', line)[0]
+
+
+def report(name, seconds, count):
+    """
+    Prints the total time and the time per lookup
+    """
+    print('%-22s %9.3f ms total %9.2f us/lookup' % (
+        name, seconds * 1000, seconds * 1000000 / max(count, 1)))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args['official_images'] is None:
+            library_dir = os.path.join(tmp_dir, 'library')
+            os.makedirs(library_dir)
+            make_library(library_dir, args['repos'], args['entries'])
+            for git_args in (['init', '-q'], ['add', '-A'],
+                             ['-c', 'user.name=bench', '-c',
+                              'user.email=bench@example.com',
+                              'commit', '-qm', 'library']):
+                subprocess.check_call(['git', '-C', tmp_dir] + git_args)
+            index_dir = os.path.join(tmp_dir, 'index')
+        else:
+            library_dir = os.path.join(args['official_images'], 'library')
+            index_dir = os.path.join(tmp_dir, 'index')
+
+        start = time.perf_counter()
+        index = LibraryIndex.build(library_dir)
+        build_time = time.perf_counter() - start
+
+        # Tags: lines only, like the FROM of a Dockerfile would use
+        lookups = []
+        for repo, library in index.repos.items():
+            for tag in library['tags']:
+                lookups.append((repo, tag))
+        print('%d repos, %d tags' % (len(index.repos), len(lookups)))
+        print('%-22s %9.3f ms' % ('index build', build_time * 1000))
+
+        library_root = os.path.dirname(library_dir)
+        LibraryIndex.load(library_root, index_dir)  # saves the index
+        start = time.perf_counter()
+        LibraryIndex.load(library_root, index_dir)
+        print('%-22s %9.3f ms' % ('index load',
+                                  (time.perf_counter() - start) * 1000))
+
+        start = time.perf_counter()
+        for repo, tag in lookups:
+            index.lookup(repo, tag)
+        report('index lookup', time.perf_counter() - start, len(lookups))
+
+        start = time.perf_counter()
+        for repo, tag in lookups:
+            linear_lookup(library_dir, repo, tag)
+        report('linear scan lookup', time.perf_counter() - start,
+               len(lookups))
+
+
+if __name__ == '__main__':
+    main()
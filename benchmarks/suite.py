@@ -0,0 +1,237 @@
+"""
+Benchmark suite of the three paths a conversion takes, on synthetic
+Dockerfiles and local fixtures (see fixtures.py), so it runs offline:
+    parse    tokenizing and converting Dockerfiles of a few sizes
+    resolve  FROM resolution of a chain of images, with an empty cache
+             (clones of the bare repos) and with a warm one
+    e2e      whole undockerize runs of a batch of services: cold cache,
+             warm cache, and again with nothing changed (manifest), as a
+             new process each time and with convert() in this one
+
+Usage: python benchmarks/suite.py [--only parse,resolve,e2e]
+                                  [--json <file>] [--compare <file>]
+--json saves the times, --compare prints how much each one changed since
+the saved ones (so regressions are visible)
+"""
+import argparse
+import contextlib
+import io
+import json
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+argparser = argparse.ArgumentParser(description='undockerize benchmark suite')
+argparser.add_argument(
+    '--only', default='parse,resolve,e2e', metavar='<benchmarks>',
+    help='Comma separated benchmarks to run; *Default: parse,resolve,e2e')
+argparser.add_argument(
+    '--sizes', default='50,500,5000', metavar='<sizes>',
+    help='RUN instructions of the parsed Dockerfiles; *Default: 50,500,5000')
+argparser.add_argument(
+    '--depth', default=5, type=int, metavar='<depth>',
+    help='Images in the FROM chain; *Default: 5')
+argparser.add_argument(
+    '--services', default=10, type=int, metavar='<services>',
+    help='Services of the end to end batch; *Default: 10')
+argparser.add_argument(
+    '--repeat', default=3, type=int, metavar='<repeat>',
+    help='Times to run each benchmark (the best one is reported); '
+         '*Default: 3')
+argparser.add_argument(
+    '--json', default=None, metavar='<file>',
+    help='Save the times to <file>')
+argparser.add_argument(
+    '--compare', default=None, metavar='<file>',
+    help='Compare the times to the ones saved in <file>')
+args = vars(argparser.parse_args())
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(bench_dir, '..', 'undockerize', 'undockerize.py')
+sys.path.insert(0, bench_dir)
+sys.path.insert(0, os.path.join(bench_dir, '..'))
+from fixtures import make_context, make_dockerfile, make_remote  # NOQA
+from undockerize.undockerize import (Ansible, Conversion, Docker,  # NOQA
+                                     convert, default_options)
+
+results = {}  # Benchmark names -> best seconds
+
+
+def best_time(name, func, setup=None, items=None, unit=None):
+    """
+    Runs func repeat times (after setup, which isn't timed) and reports the
+    best time (and the items/second if given)
+    """
+    times = []
+    for _ in range(args['repeat']):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    results[name] = min(times)
+    line = '%-28s %10.3f ms' % (name, results[name] * 1000)
+    if items is not None:
+        line += ' %12.0f %s/s' % (items / results[name], unit)
+    print(line)
+
+
+def bench_parse(tmp_dir):
+    """
+    Times tokenizing a Dockerfile, converting it to Tasks, and converting
+    it while it streams to a tasks file
+    """
+    for size in [int(size) for size in args['sizes'].split(',')]:
+        context_dir = os.path.join(tmp_dir, 'parse%d' % size)
+        file_name = os.path.join(context_dir, 'Dockerfile')
+        os.makedirs(context_dir)
+        copies = max(size // 10, 1)
+        with open(file_name, 'w') as f:
+            make_dockerfile(f, runs=size, envs=size // 5, copies=copies)
+        make_context(context_dir, copies)
+        with open(file_name, 'r') as f:
+            lines = sum(1 for _ in f)
+        print('%d line Dockerfile' % lines)
+
+        dockers = []
+        best_time('parse %d tokenize' % size,
+                  lambda: Docker(file_name, context_dir),
+                  items=lines, unit='lines')
+        best_time('parse %d convert' % size,
+                  lambda: dockers[-1].parse_docker(),
+                  setup=lambda: dockers.append(
+                      Docker(file_name, context_dir)),
+                  items=lines, unit='lines')
+        tasks_file = os.path.join(tmp_dir, 'tasks%d' % size)
+        best_time('parse %d write' % size,
+                  lambda: write_tasks(dockers[-1], tasks_file),
+                  setup=lambda: dockers.append(
+                      Docker(file_name, context_dir)),
+                  items=lines, unit='lines')
+
+
+def write_tasks(docker, file_name):
+    """
+    Converts docker while it streams to file_name
+    """
+    with Ansible(file_name) as ansible_file:
+        docker.parse_docker(ansible_file)
+
+
+def bench_resolve(options, cache_dir, top):
+    """
+    Times resolving the chain of top (and making the Docker objects of its
+    images) from the bare repos, without and with a cache
+    """
+    conversions = []
+
+    def reset(cold):
+        if cold:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        conversions.append(Conversion(options))
+
+    def resolve():
+        chain = conversions[-1].get_repos_with_FROM('FROM ' + top)
+        assert len(chain) == args['depth'], chain
+
+    print('FROM chain of %d images' % args['depth'])
+    best_time('resolve cold', resolve, setup=lambda: reset(True),
+              items=args['depth'], unit='images')
+    best_time('resolve warm', resolve, setup=lambda: reset(False),
+              items=args['depth'], unit='images')
+
+
+def bench_e2e(options, tmp_dir, cache_dir, top):
+    """
+    Times undockerize runs of a batch of services that are all FROM top
+    """
+    batch_dir = os.path.join(tmp_dir, 'batch')
+    for x in range(args['services']):
+        service_dir = os.path.join(batch_dir, 'service%d' % x)
+        os.makedirs(service_dir)
+        with open(os.path.join(service_dir, 'Dockerfile'), 'w') as f:
+            make_dockerfile(f, runs=100, envs=20, copies=5, base=top)
+        make_context(service_dir, 5)
+    work_dir = os.path.join(tmp_dir, 'work')
+    os.makedirs(work_dir)
+
+    def run():
+        subprocess.check_call(
+            [sys.executable, script, '-b', batch_dir, '--git-base',
+             options['git_base'], '--cache-dir', cache_dir],
+            cwd=work_dir, stdout=subprocess.DEVNULL)
+
+    def run_in_process():
+        convert(options=options, batch=batch_dir, output_dir=work_dir)
+
+    def clean(cold):
+        for name in os.listdir(work_dir):
+            path = os.path.join(work_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        if cold:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print('%d services FROM a chain of %d images' % (
+        args['services'], args['depth']))
+    services = args['services']
+    best_time('e2e cold', run, setup=lambda: clean(True),
+              items=services, unit='services')
+    best_time('e2e warm', run, setup=lambda: clean(False),
+              items=services, unit='services')
+    best_time('e2e unchanged', run, items=services, unit='services')
+    best_time('e2e in process cold', run_in_process,
+              setup=lambda: clean(True), items=services, unit='services')
+    best_time('e2e in process warm', run_in_process,
+              setup=lambda: clean(False), items=services, unit='services')
+    best_time('e2e in process unchanged', run_in_process, items=services,
+              unit='services')
+
+
+def compare(file_name):
+    """
+    Prints the change of every time since the ones saved in file_name
+    """
+    with open(file_name, 'r') as f:
+        old_results = json.load(f)
+    print('\nChange since ' + file_name)
+    for name, seconds in results.items():
+        old_seconds = old_results.get(name)
+        if old_seconds:
+            print('%-28s %+9.1f %%' % (
+                name, (seconds - old_seconds) * 100 / old_seconds))
+
+
+def main():
+    only = args['only'].split(',')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        remote_dir = os.path.join(tmp_dir, 'remote')
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        top = make_remote(remote_dir, args['depth'], extra_repos=100)
+        options = dict(default_options(), git_base=remote_dir + '/',
+                       cache_dir=cache_dir,
+                       output_dir=os.path.join(tmp_dir, 'resolve'))
+
+        if 'parse' in only:
+            bench_parse(tmp_dir)
+        if 'resolve' in only:
+            bench_resolve(options, cache_dir, top)
+        if 'e2e' in only:
+            bench_e2e(options, tmp_dir, cache_dir, top)
+
+    if args['json'] is not None:
+        with open(args['json'], 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+    if args['compare'] is not None:
+        compare(args['compare'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Fixtures of the tests: the bare repos of benchmarks/fixtures.py as the
+--git-base (so nothing is fetched from the network) and a conversion in a
+temp dir that uses them
+"""
+import os.path
+import sys
+
+import pytest
+
+root_dir = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'benchmarks'))
+
+from fixtures import make_remote  # noqa: E402
+from undockerize import undockerize  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def remote(tmp_path_factory):
+    """
+    Bare repos of image0:1.0 (FROM debian:stable) and image1:1.0 (FROM
+    image0:1.0) and their official-images library
+    """
+    remote_dir = str(tmp_path_factory.mktemp('remote'))
+    make_remote(remote_dir, 2)
+    return remote_dir
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    """
+    Empty dir the test runs in (the output dir of the conversions)
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def run(work_dir, remote):
+    """
+    Converts the text of a Dockerfile (written to Dockerfile in the work
+    dir, so its COPYs use the files there) with the options given
+    Returns the Conversion
+    """
+    def run(dockerfile, **options):
+        with open('Dockerfile', 'w') as f:
+            f.write(dockerfile)
+        options.setdefault('git_base', remote)
+        options.setdefault('cache_dir', str(work_dir / 'cache'))
+        return undockerize.convert('Dockerfile', options)
+    return run
+
+
+def read(path):
+    """
+    Returns the content of a file of the work dir
+    """
+    with open(path) as f:
+        return f.read()
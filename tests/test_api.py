@@ -0,0 +1,36 @@
+"""
+Tests of convert() (user-017)
+"""
+import logging
+
+import pytest
+
+from undockerize import undockerize
+
+
+def test_unknown_option(run):
+    with pytest.raises(undockerize.UndockerizeError):
+        run('FROM debian:stable\n', no_such_option=True)
+
+
+def test_convert_logs_instead_of_printing(run, capsys, caplog):
+    caplog.set_level(logging.INFO, logger='undockerize')
+    run('FROM image1:1.0\n'
+        'COPY missing.txt /app/\n')
+    assert capsys.readouterr().out == ''
+    messages = [(record.levelno, record.getMessage())
+                for record in caplog.records]
+    assert (logging.INFO,
+            'ansible-playbook site.yml -u <user> -i <host>,') in messages
+    assert any(level == logging.WARNING and
+               message.startswith('Possible copy issue with file:')
+               for level, message in messages)
+
+
+def test_cli_formatter():
+    record = logging.LogRecord('undockerize', logging.WARNING, __file__, 0,
+                               'Could not fetch %s', ('x',), None)
+    assert (undockerize.CLIFormatter().format(record) ==
+            'WARNING: Could not fetch x')
+    record.levelno = logging.INFO
+    assert undockerize.CLIFormatter().format(record) == 'Could not fetch x'
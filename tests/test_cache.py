@@ -0,0 +1,55 @@
+"""
+Tests of the cache of checkouts (user-001, user-004) against the local bare
+repos
+"""
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+
+from conftest import undockerize
+
+
+def make_cache(cache_dir, sparse=True, offline=False, ttl=3600):
+    return undockerize.Cache(str(cache_dir), ttl, 2 ** 30, offline, sparse,
+                             undockerize.Stats(True))
+
+
+def test_clone_then_use_cached(tmp_path, remote):
+    cache = make_cache(tmp_path, sparse=False)
+    path = cache.fetch(os.path.join(remote, 'image0.git'))
+    assert os.path.isfile(os.path.join(path, '1.0', 'Dockerfile'))
+    again = make_cache(tmp_path, sparse=False)
+    assert again.fetch(os.path.join(remote, 'image0.git')) == path
+    assert cache.stats.counters == {'repos cloned': 1}
+    assert again.stats.counters == {}
+    # only clones are in the repos dir
+    assert [name for name in os.listdir(cache.repos_dir)
+            if os.path.isdir(os.path.join(cache.repos_dir, name))] == [
+        os.path.basename(path)]
+
+
+def test_sparse_checks_out_the_directory(tmp_path, remote):
+    cache = make_cache(tmp_path)
+    path = cache.fetch(os.path.join(remote, 'image0.git'), '1.0')
+    assert os.path.isfile(os.path.join(path, '1.0', 'Dockerfile'))
+    assert not os.path.exists(os.path.join(path, '1.0', 'dir 0'))
+
+
+def test_offline_miss_and_bad_link(tmp_path, remote):
+    assert make_cache(tmp_path, offline=True).fetch(
+        os.path.join(remote, 'image0.git'), '1.0') is None
+    cache = make_cache(tmp_path)
+    assert cache.fetch(os.path.join(remote, 'missing.git'), '1.0') is None
+    assert [name for name in os.listdir(cache.repos_dir)
+            if not name.endswith('.lock')] == []
+
+
+def fetch(cache_dir, link):
+    return make_cache(cache_dir).fetch(link, '1.0')
+
+
+def test_runs_sharing_a_cold_cache(tmp_path, remote):
+    link = os.path.join(remote, 'image1.git')
+    with ProcessPoolExecutor(4) as pool:
+        paths = list(pool.map(fetch, [tmp_path] * 8, [link] * 8))
+    assert len(set(paths)) == 1 and paths[0] is not None
+    assert os.path.isfile(os.path.join(paths[0], '1.0', 'Dockerfile'))
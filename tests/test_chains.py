@@ -0,0 +1,103 @@
+"""
+Tests of following the FROM chains through the local bare repos: batches
+(user-002), the worker pool (user-003), where chains stop (user-014),
+staging (user-019) and the tasks cache (user-021)
+"""
+import filecmp
+import os
+import os.path
+
+from conftest import read, undockerize
+
+DOCKERFILE = 'FROM image1:1.0\nRUN echo hi\n'
+
+
+def site_roles(file_name):
+    return [line.strip()[2:] for line in read(file_name).splitlines()
+            if line.startswith('    - ')]
+
+
+def test_chain(run):
+    conversion = run(DOCKERFILE)
+    assert conversion.roles == ['UnDockerized', 'image1_1.0', 'image0_1.0']
+    assert conversion.stopped_images == {}
+    assert site_roles('site.yml') == ['image0_1.0', 'image1_1.0',
+                                      'UnDockerized']
+    assert os.path.isfile('UnDock_Dependencies/image0/1.0/Dockerfile')
+
+
+def test_jobs_give_the_same_roles(run):
+    run(DOCKERFILE, jobs=1, output_dir='one')
+    run(DOCKERFILE, jobs=4, output_dir='four')
+    for role in ('UnDockerized', 'image1_1.0', 'image0_1.0'):
+        tasks_file = 'roles/' + role + '/tasks/main.yml'
+        assert filecmp.cmp('one/' + tasks_file, 'four/' + tasks_file,
+                           shallow=False)
+    assert read('one/site.yml') == read('four/site.yml')
+
+
+def test_max_depth(run):
+    conversion = run(DOCKERFILE, max_depth=1, stats=True)
+    assert conversion.roles == ['UnDockerized', 'image1_1.0']
+    assert conversion.stopped_images == {'image0:1.0': 'past --max-depth'}
+    assert not os.path.exists('UnDock_Dependencies/image0')
+    assert conversion.stats.counters['repos cloned'] == 2  # and the library
+
+
+def test_provided(run):
+    conversion = run(DOCKERFILE, provided=['image1:*'])
+    assert conversion.roles == ['UnDockerized']
+    assert conversion.stopped_images == {'image1:1.0': 'provided'}
+    assert site_roles('site.yml') == ['UnDockerized']
+
+
+def test_batch_shares_base_roles(run, work_dir):
+    for service, base in (('web', 'image1:1.0'), ('worker', 'image0:1.0')):
+        (work_dir / 'services' / service).mkdir(parents=True)
+        (work_dir / 'services' / service / 'Dockerfile').write_text(
+            'FROM ' + base + '\nRUN echo ' + service + '\n')
+    conversion = run(DOCKERFILE, batch='services', stats=True)
+    assert sorted(conversion.roles) == ['image0_1.0', 'image1_1.0', 'web',
+                                        'worker']
+    assert conversion.stats.counters['roles written'] == 4
+    assert site_roles('site_web.yml') == ['image0_1.0', 'image1_1.0', 'web']
+    assert site_roles('site_worker.yml') == ['image0_1.0', 'worker']
+    assert not os.path.exists('roles/UnDockerized')
+
+
+def test_staged_names():
+    names = ['Dockerfile', 'a.txt', 'b.txt', 'c.ini']
+    assert undockerize.staged_names(['*.txt', 'sub/c.ini'], names) == {
+        'Dockerfile', 'a.txt', 'b.txt'}
+    assert undockerize.staged_names(['.'], names) == set(names)
+    assert undockerize.staged_names(None, names) == set(names)
+
+
+def test_staging_link(run, work_dir):
+    conversion = run(DOCKERFILE, staging='link', stats=True)
+    counters = conversion.stats.counters
+    # every file next to the Dockerfiles is used by their COPYs and ADDs
+    assert sum(counters.get('files ' + how, 0)
+               for how in ('reflinked', 'linked', 'copied')) == 14
+    staged = 'UnDock_Dependencies/image0/1.0/file_0.txt'
+    cached = [os.path.join(root, 'file_0.txt')
+              for root, _, files in os.walk(str(work_dir / 'cache'))
+              if 'file_0.txt' in files and root.endswith('1.0')]
+    assert any(filecmp.cmp(staged, path, shallow=False) for path in cached)
+    if counters.get('files linked'):
+        assert any(os.path.samefile(staged, path) for path in cached)
+
+
+def test_tasks_cache(run):
+    assert run(DOCKERFILE, stats=True).stats.counters[
+        'task cache misses'] == 3
+    # another output dir has no roles to leave alone, but the base images
+    # were converted before
+    counters = run(DOCKERFILE, output_dir='again', stats=True).stats.counters
+    assert counters['task cache hits'] == 3
+    assert 'task cache misses' not in counters
+    tasks_file = 'roles/image0_1.0/tasks/main.yml'
+    assert read(tasks_file) == read('again/' + tasks_file)
+    counters = run(DOCKERFILE, output_dir='fresh', no_cache=True,
+                   stats=True).stats.counters
+    assert 'task cache hits' not in counters
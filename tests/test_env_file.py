@@ -0,0 +1,38 @@
+"""
+Tests of --env-file (user-025)
+"""
+from conftest import read
+
+
+def test_template_at_first_env(run):
+    run('FROM debian:stable\n'
+        'RUN echo start\n'
+        'ENV APP=/opt/app MODE=dev\n'
+        'RUN echo $APP $MODE\n'
+        'ENV MODE=prod\n'
+        'RUN echo $APP $MODE\n', env_file=True)
+    tasks = read('roles/UnDockerized/tasks/main.yml')
+    assert tasks.index('echo start') < tasks.index('template:') < \
+        tasks.index('echo $APP')
+    assert 'lineinfile' not in tasks
+    # MODE is dev here, but prod in the role's vars
+    assert tasks.count('environment:\n    APP: /opt/app\n    MODE: dev') == 1
+    assert tasks.endswith(
+        'environment: "{{ UnDockerized_environment }}"\n')
+    assert read('roles/UnDockerized/defaults/main.yml') == (
+        '---\nUnDockerized_environment:\n  APP: /opt/app\n  MODE: prod\n')
+    assert 'export {{ var }}' in read(
+        'roles/UnDockerized/templates/environment.sh.j2')
+
+
+def test_only_the_vars_a_task_uses(run):
+    run('FROM debian:stable\n'
+        'ENV PATH=/opt/bin:$PATH APP=/opt/app\n'
+        'RUN ls $APP\n'
+        'RUN ls $APP $PATH\n', env_file=True)
+    tasks = read('roles/UnDockerized/tasks/main.yml')
+    assert '_environment' not in tasks
+    assert 'environment:\n    APP: /opt/app\n\n' in tasks
+    assert 'PATH: /opt/bin:$PATH' in tasks  # as it was without env_file
+    assert 'PATH: /opt/bin:$PATH' in read(
+        'roles/UnDockerized/defaults/main.yml')
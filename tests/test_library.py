@@ -0,0 +1,52 @@
+"""
+Tests of the official-images library index (user-005)
+"""
+import os.path
+import subprocess
+
+import pytest
+
+from conftest import undockerize
+
+
+@pytest.fixture
+def library_dir(tmp_path, remote):
+    library_dir = str(tmp_path / 'official-images')
+    subprocess.check_call(['git', 'clone', '-q',
+                           os.path.join(remote, 'official-images.git'),
+                           library_dir])
+    return library_dir
+
+
+def test_lookup(library_dir, tmp_path):
+    index = undockerize.LibraryIndex.load(library_dir, str(tmp_path / 'idx'))
+    assert index.lookup('image1', '1.0') == {
+        'GitCommit': '%040x' % 1, 'Directory': '1.0',
+        'Architectures': 'amd64'}
+    assert index.lookup('image1', '2.0') is None
+    assert index.lookup('debian', 'stable') is None
+
+
+def test_cut_off_index_is_rebuilt(library_dir, tmp_path):
+    index_dir = str(tmp_path / 'idx')
+    index = undockerize.LibraryIndex.load(library_dir, index_dir)
+    [index_file] = os.listdir(index_dir)
+    with open(os.path.join(index_dir, index_file), 'w') as f:
+        f.write('{"image0": {"ta')
+    again = undockerize.LibraryIndex.load(library_dir, index_dir)
+    assert again.repos == index.repos
+    assert os.listdir(index_dir) == [index_file]
+    with open(os.path.join(index_dir, index_file)) as f:
+        assert f.read().startswith('{"image0":')
+
+
+def test_only_old_indexes_are_removed(library_dir, tmp_path):
+    index_dir = tmp_path / 'idx'
+    index_dir.mkdir()
+    (index_dir / 'recent.json').write_text('{}')
+    (index_dir / 'old.json').write_text('{}')
+    os.utime(str(index_dir / 'old.json'), (0, 0))
+    undockerize.LibraryIndex.load(library_dir, str(index_dir))
+    names = sorted(os.listdir(str(index_dir)))
+    assert 'recent.json' in names and 'old.json' not in names
+    assert len(names) == 2
@@ -0,0 +1,55 @@
+"""
+Tests of incremental runs (user-011, user-020)
+"""
+import os.path
+
+from conftest import read
+
+DOCKERFILE = 'FROM image0:1.0\nCOPY *.txt /app/\n'
+
+
+def counters(conversion):
+    return {name: count for name, count in conversion.stats.counters.items()
+            if name.startswith('roles ')}
+
+
+def test_unchanged_rerun_leaves_roles_alone(run, work_dir):
+    (work_dir / 'a.txt').write_text('a')
+    assert counters(run(DOCKERFILE, stats=True)) == {'roles written': 2}
+    tasks_file = 'roles/UnDockerized/tasks/main.yml'
+    mtime = os.path.getmtime(tasks_file)
+    # the output (roles, site.yml, the manifest) is in the build context
+    assert counters(run(DOCKERFILE, stats=True)) == {'roles up to date': 2}
+    assert os.path.getmtime(tasks_file) == mtime
+
+
+def test_paths_the_copies_use(run, work_dir):
+    (work_dir / 'a.txt').write_text('a')
+    run(DOCKERFILE)
+    (work_dir / 'notes.md').write_text('not copied')
+    assert counters(run(DOCKERFILE, stats=True)) == {'roles up to date': 2}
+    (work_dir / 'b.txt').write_text('b')
+    assert counters(run(DOCKERFILE, stats=True)) == {
+        'roles written': 1, 'roles up to date': 1}
+    tasks = read('roles/UnDockerized/tasks/main.yml')
+    assert 'a.txt' in tasks and 'b.txt' in tasks
+
+
+def test_changed_dockerfile_is_converted_again(run):
+    run('FROM image0:1.0\nRUN echo one\n')
+    conversion = run('FROM image0:1.0\nRUN echo two\n', stats=True)
+    assert counters(conversion) == {'roles written': 1,
+                                    'roles up to date': 1}
+    assert 'echo two' in read('roles/UnDockerized/tasks/main.yml')
+
+
+def test_image_that_could_not_be_fetched(run):
+    run('FROM image1:1.0\n', max_depth=1)  # the library and image1 only
+    conversion = run('FROM image1:1.0\n', offline=True)
+    assert conversion.stopped_images == {'image0:1.0': 'could not be fetched'}
+    # the manifest doesn't remember it, so the next run converts it
+    conversion = run('FROM image1:1.0\n', stats=True)
+    assert conversion.stopped_images == {}
+    assert counters(conversion) == {'roles written': 1,
+                                    'roles up to date': 2}
+    assert os.path.isfile('roles/image0_1.0/tasks/main.yml')
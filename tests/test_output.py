@@ -0,0 +1,61 @@
+"""
+Tests of how the tasks files are written (user-007, user-008, user-022)
+"""
+import json
+import os.path
+import stat
+
+import pytest
+
+from conftest import read, undockerize
+
+DOCKERFILE = 'FROM image0:1.0\nRUN echo hi\n'
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@pytest.mark.parametrize('atomic', [False, True])
+def test_atomic_files_have_the_same_mode(run, atomic):
+    run(DOCKERFILE, atomic=atomic)
+    expected = 0o666 & ~undockerize.umask
+    for role in ('UnDockerized', 'image0_1.0'):
+        assert mode('roles/' + role + '/tasks/main.yml') == expected
+    assert not any(name.startswith('.undockerize-')
+                   for name in os.listdir('roles/UnDockerized/tasks'))
+
+
+def test_streams_tasks(tmp_path):
+    file_name = str(tmp_path / 'roles' / 'r' / 'tasks' / 'main')
+    with undockerize.Ansible(file_name, atomic=True) as ansible_file:
+        ansible_file.append(undockerize.Task('Say hi', 'shell', 'echo hi'))
+        # nothing is moved into place until it's closed
+        assert not os.path.exists(file_name + '.yml')
+    assert read(file_name + '.yml') == (
+        '---\n- name: Say hi\n  shell: echo hi\n')
+
+
+def test_yaml_round_trip():
+    yaml = pytest.importorskip('yaml')
+    task = undockerize.Task('Tricky', 'shell', 'echo "a: b" #c\n  two\n', {
+        'args': {'chdir': '~/'}, 'with_items': ['yes', '1.0', '-x', '']})
+    task.environment = {'A': ' spaced ', 'B': 'null'}
+    assert yaml.safe_load('\n'.join(task.to_yaml())) == [task.to_dict()]
+
+
+def test_json_format(run):
+    conversion = run(DOCKERFILE, format='json')
+    assert conversion.tasks_files['UnDockerized'] == (
+        'roles/UnDockerized/tasks/main.json')
+    tasks = json.loads(read('roles/UnDockerized/tasks/main.json'))
+    assert tasks[-1]['shell'] == 'echo hi'
+
+
+def test_parse_jobs_give_the_same_roles(run):
+    run('FROM image1:1.0\nRUN echo hi\n', output_dir='one')
+    run('FROM image1:1.0\nRUN echo hi\n', output_dir='two', parse_jobs=2,
+        no_cache=True)
+    for role in ('UnDockerized', 'image1_1.0', 'image0_1.0'):
+        tasks_file = 'roles/' + role + '/tasks/main.yml'
+        assert read('one/' + tasks_file) == read('two/' + tasks_file)
@@ -0,0 +1,115 @@
+"""
+Tests of what RUNs become (user-009, user-010, user-006, user-023,
+user-024)
+"""
+import pytest
+
+from conftest import read
+
+yaml = pytest.importorskip('yaml')
+
+
+def tasks():
+    return yaml.safe_load(read('roles/UnDockerized/tasks/main.yml'))
+
+
+def test_coalesce_runs(run):
+    run('FROM debian:stable\n'
+        'RUN echo one\n'
+        'RUN echo two\n'
+        'WORKDIR /app\n'
+        'RUN echo three\n', coalesce_runs=True)
+    shells = [task['shell'] for task in tasks() if 'shell' in task]
+    assert shells == ['(echo one) && (echo two)', 'mkdir -p /app',
+                      'cd /app && echo three']
+
+
+def test_native_packages(run):
+    run('FROM debian:stable\n'
+        'ENV PKGS="curl git"\n'
+        'RUN apt-get update && apt-get install -y --no-install-recommends '
+        '$PKGS make && rm -rf /var/lib/apt/lists/*\n'
+        'RUN pip install -U flask\n', native_packages=True)
+    apt, pip = [task for task in tasks() if 'shell' not in task][1:]
+    assert apt['apt'] == {'update_cache': True, 'cache_valid_time': 3600,
+                          'name': ['curl', 'git', 'make'],
+                          'install_recommends': False}
+    assert pip['pip'] == {'name': ['flask'], 'state': 'latest'}
+
+
+def test_native_packages_are_not_coalesced(run):
+    run('FROM debian:stable\n'
+        'ENV PKGS=git\n'
+        'RUN echo one\n'
+        'RUN apt-get install -y $PKGS\n'
+        'RUN echo two\n'
+        'RUN echo three\n', coalesce_runs=True, native_packages=True)
+    modules = [[key for key in task if key != 'name'] for task in tasks()]
+    assert modules == [['lineinfile'], ['shell'], ['apt'], ['shell']]
+    assert tasks()[2]['apt'] == {'name': ['git']}
+
+
+def test_other_runs_stay_shell_tasks(run):
+    run('FROM debian:stable\n'
+        'RUN apt-get install -y curl | tee log\n'
+        'RUN apt-get install -y $UNSET\n', native_packages=True)
+    assert [task['shell'] for task in tasks()] == [
+        'apt-get install -y curl | tee log', 'apt-get install -y $UNSET']
+
+
+def test_shebang_heredoc_is_a_script(run):
+    run('FROM debian:stable\n'
+        'WORKDIR /app\n'
+        'RUN <<EOT\n'
+        '#!/usr/bin/env python3\n'
+        'print("hi")\n'
+        'EOT\n'
+        'RUN <<EOT\n'
+        'echo hi\n'
+        'EOT\n')
+    script, shell = tasks()[1:]
+    assert script['script']['chdir'] == '/app'
+    assert read('roles/UnDockerized/files/' + script['script']['cmd']) == (
+        '#!/usr/bin/env python3\nprint("hi")\n')
+    assert shell['shell'] == 'cd /app && echo hi\n'
+
+
+def test_script_threshold(run):
+    run('FROM debian:stable\n'
+        'WORKDIR /app\n'
+        'RUN echo short\n'
+        'RUN echo "a long command that goes over the threshold"\n'
+        'RUN <<EOT\n'
+        '#!/usr/bin/env python3\n'
+        'print("hi")\n'
+        'EOT\n', script_threshold=30)
+    short, long_run, python = tasks()[1:]
+    assert short['shell'] == 'cd /app && echo short'
+    script = read('roles/UnDockerized/files/' + long_run['script']['cmd'])
+    assert script.startswith('#!/bin/sh\n(\ncd /app && echo "a long')
+    assert long_run['script']['creates'].startswith('~/.undockerize/')
+    assert read('roles/UnDockerized/files/' + python['script']['cmd']) == (
+        '#!/usr/bin/env python3\nprint("hi")\n')
+    assert python['script']['chdir'] == '/app'
+
+
+def test_idempotent_creates(run):
+    run('FROM debian:stable\n'
+        'ENV HOME_DIR=/opt\n'
+        'WORKDIR $HOME_DIR\n'
+        'RUN wget https://example.com/x.tgz\n'
+        'RUN cd /tmp && wget https://example.com/y.tgz\n'
+        'WORKDIR $UNSET/sub\n'
+        'RUN wget https://example.com/z.tgz\n'
+        'WORKDIR /srv\n'
+        'WORKDIR app\n'
+        'RUN curl -o a.tgz https://example.com/a.tgz\n', idempotent=True)
+    shells = [task['shell'] for task in tasks()
+              if isinstance(task.get('shell'), dict)]
+    stamps = ['~/.undockerize/' + shell['cmd'].split('/')[-1].rstrip('"')
+              for shell in shells]
+    assert [shell['creates'] for shell in shells] == [
+        '/opt/x.tgz', stamps[1], stamps[2], '/srv/app/a.tgz']
+    assert shells[1]['cmd'].startswith('cd $HOME_DIR && cd /tmp && wget ')
+    workdirs = [task['file']['path'] for task in tasks() if 'file' in task]
+    assert workdirs == ['/opt', '/srv', '/srv/app']
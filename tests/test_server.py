@@ -0,0 +1,105 @@
+"""
+Tests of the stats of a run (user-015) and undockerize serve (user-018)
+"""
+import http.client
+import io
+import json
+import tarfile
+import threading
+
+import pytest
+
+from conftest import undockerize
+
+DOCKERFILE = 'FROM image1:1.0\nRUN echo hi\n'
+
+
+@pytest.fixture
+def server(work_dir, remote):
+    options = dict(undockerize.default_options(), git_base=remote,
+                   cache_dir=str(work_dir / 'cache'), memory_size=8)
+    return undockerize.Server(options)
+
+
+def names(archive):
+    with tarfile.open(fileobj=io.BytesIO(archive), mode='r:gz') as tar:
+        return tar.getnames()
+
+
+def test_stats(run, work_dir):
+    conversion = run(DOCKERFILE, stats=True)
+    report = conversion.stats.report()
+    assert report['counters']['roles written'] == 3
+    assert report['timers']['tokenize']['count'] == 3
+    assert report['timers']['handle RUN']['count'] > 0
+    assert conversion.stats.summary()[0].startswith('Stats (')
+    # nothing is counted unless it's asked for
+    assert run(DOCKERFILE, output_dir='quiet').stats.counters == {}
+
+
+def test_stats_json(work_dir, remote):
+    (work_dir / 'Dockerfile').write_text(DOCKERFILE)
+    undockerize.main(['--git-base', remote, '--cache-dir',
+                      str(work_dir / 'cache'), '--stats-json', 'stats.json'])
+    with open('stats.json') as f:
+        report = json.load(f)
+    assert report['counters']['roles written'] == 3
+
+
+def test_convert(server):
+    archive = server.convert(DOCKERFILE, 'output_role=web&max_depth=1')
+    assert 'roles/web/tasks/main.yml' in names(archive)
+    assert 'roles/image1_1.0/tasks/main.yml' in names(archive)
+    assert 'roles/image0_1.0/tasks/main.yml' not in names(archive)
+    assert 'site.yml' in names(archive)
+    assert '.undockerize.json' not in names(archive)
+    server.convert(DOCKERFILE, 'output_role=web')
+    metrics = server.metrics()
+    assert metrics['requests'] == 2 and metrics['errors'] == 0
+    # the second request already knew the Dockerfile and image1:1.0
+    assert metrics['memory']['dockerfiles']['hits'] > 0
+    assert metrics['memory']['images']['hits'] > 0
+
+
+@pytest.mark.parametrize('query', ['clean=1', 'max_depth=x', 'format=xml',
+                                   'output_role=../web'])
+def test_bad_requests(server, query):
+    with pytest.raises(undockerize.UndockerizeError):
+        server.convert(DOCKERFILE, query)
+    assert server.metrics()['errors'] == 1
+
+
+def test_http(server):
+    httpd = server.make_http_server('127.0.0.1:0')
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection(*httpd.server_address)
+        connection.request('POST', '/convert?format=json', DOCKERFILE)
+        response = connection.getresponse()
+        assert response.status == 200
+        assert 'roles/UnDockerized/tasks/main.json' in names(response.read())
+        connection.request('POST', '/convert?jobs=2', DOCKERFILE)
+        response = connection.getresponse()
+        assert response.status == 400
+        assert response.read() == b'Unknown option "jobs"\n'
+        connection.request('GET', '/metrics')
+        metrics = json.loads(connection.getresponse().read())
+        assert (metrics['requests'], metrics['errors']) == (2, 1)
+        connection.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+
+def test_lru():
+    lru = undockerize.LRU(2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)  # b is the least recently used
+    assert lru.get('b') is None
+    assert lru.metrics() == {'size': 2, 'max_size': 2, 'hits': 1,
+                             'misses': 1, 'evictions': 1}
+    assert undockerize.LRU(2, ttl=0).get('a') is None
@@ -0,0 +1,30 @@
+"""
+Tests of multi-stage Dockerfiles (user-013)
+"""
+from conftest import read
+
+
+def test_diamond_stage_graph(run):
+    # the builder stage and the last stage both need image0
+    conversion = run('FROM image1:1.0 AS builder\n'
+                     'RUN echo build\n'
+                     'FROM image0:1.0\n'
+                     'COPY --from=builder /x /x\n', stats=True, jobs=1)
+    assert sorted(conversion.roles) == [
+        'UnDockerized', 'UnDockerized_builder', 'image0_1.0', 'image1_1.0']
+    assert conversion.stats.counters['roles written'] == 4
+    tasks = read('roles/image0_1.0/tasks/main.yml')
+    assert '$ROOT/$ROOT' not in tasks
+    assert read('site.yml').split('roles:\n')[1].split() == [
+        '-', 'image0_1.0', '-', 'image1_1.0', '-', 'UnDockerized_builder',
+        '-', 'UnDockerized']
+
+
+def test_stage_copies_from_other_stage(run):
+    run('FROM debian:stable AS build\n'
+        'RUN make\n'
+        'FROM debian:stable\n'
+        'COPY --from=build /out /out\n')
+    assert 'make' in read('roles/UnDockerized_build/tasks/main.yml')
+    site = read('site.yml')
+    assert site.index('UnDockerized_build') < site.index('- UnDockerized\n')
@@ -0,0 +1,80 @@
+"""
+Tests of the tokenizer (user-006) and the ENV/ARG symbol table (user-012)
+"""
+import pytest
+
+from conftest import read, undockerize
+
+
+def tokens(text):
+    return [(token.command, token.args, token.start, token.end)
+            for token in undockerize.tokenize_dockerfile(
+                text.splitlines(True))]
+
+
+def test_continuations_and_comments():
+    assert tokens('# base\n'
+                  'FROM debian:stable\n'
+                  '\n'
+                  'run apt-get update && \\\n'
+                  '# dropped\n'
+                  '\n'
+                  '    apt-get install -y curl\n'
+                  'CMD ["sh"]') == [
+        ('FROM', 'debian:stable', 2, 2),
+        ('RUN', 'apt-get update && apt-get install -y curl', 4, 7),
+        ('CMD', '["sh"]', 8, 8)]
+    first = next(undockerize.tokenize_dockerfile(['# base\n', 'FROM x\n']))
+    assert first.comments == ['# base']
+
+
+def test_escape_directive():
+    assert tokens('# escape=`\n'
+                  'FROM windows\n'
+                  'RUN dir c:\\ `\n'
+                  '    && echo done\n') == [
+        ('FROM', 'windows', 2, 2),
+        ('RUN', 'dir c:\\ && echo done', 3, 4)]
+
+
+def test_heredocs():
+    instructions = list(undockerize.tokenize_dockerfile(
+        'FROM x\n'
+        'COPY <<one <<-"two" /app/\n'
+        'first\n'
+        'one\n'
+        '\tsecond\n'
+        '\ttwo\n'
+        'RUN echo after\n'.splitlines(True)))
+    copy = instructions[1]
+    assert copy.heredocs == [('one', 'first\n'), ('two', 'second\n')]
+    assert (copy.start, copy.end) == (2, 6)
+    assert instructions[2].args == 'echo after'
+
+
+def test_expand():
+    env = undockerize.Environment()
+    env.declare('VERSION', '1.0')
+    assert env.expand('image:$VERSION') == 'image:1.0'
+    env.stage()
+    # a stage only sees the global ARGs it declares again
+    assert env.expand('$VERSION') == '$VERSION'
+    env.declare('VERSION')
+    env.set('ROOT', '/opt')
+    assert env.expand('${ROOT}/$VERSION ${UNSET:-none} ${ROOT:+set}') == (
+        '/opt/1.0 none set')
+    assert env.expand('$ROOT/$UNSET') == '/opt/$UNSET'
+    assert env.expand('$ROOT/$UNSET', strict=True) is None
+    assert dict(env.used('$ROOT $UNSET')) == {'ROOT': '/opt'}
+
+
+def test_env_values_use_earlier_ones(run):
+    yaml = pytest.importorskip('yaml')
+    run('FROM debian:stable\n'
+        'ENV ROOT=/opt\n'
+        'ENV APP="$ROOT/my app"\n'
+        'WORKDIR $APP\n'
+        'RUN make\n')
+    task = yaml.safe_load(read('roles/UnDockerized/tasks/main.yml'))[-1]
+    assert task['shell'] == 'cd $APP && make'
+    assert task['environment'] == {'APP': '/opt/my app'}
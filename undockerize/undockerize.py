@@ -1,10 +1,717 @@
 import argparse
+import collections
+import contextlib
+import cProfile
+import fnmatch
+import functools
+import hashlib
+import http.server
+import io
+import json
+import logging
 import urllib.parse
 import os.path
-import urllib.request
+import shlex
 import shutil
 import re
-from subprocess import call as subprocess_call, PIPE
+import signal
+import socketserver
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from subprocess import call as subprocess_call, run as subprocess_run, PIPE
+try:
+    import fcntl  # for reflinks
+except ImportError:  # not on Windows
+    fcntl = None
+
+__version__ = '0.0.1'
+
+FICLONE = 0x40049409  # ioctl that reflinks a file on Linux
+
+# what a conversion reports (the command line prints it, see log_to_stdout)
+logger = logging.getLogger('undockerize')
+
+# umask of the process (read once, before there are threads that make files)
+umask = os.umask(0)
+os.umask(umask)
+
+
+class Instruction:
+    """
+    Instruction Class
+    ----------------------------------------
+    One instruction of a Dockerfile as found by tokenize_dockerfile
+    """
+    __slots__ = ('command', 'args', 'start', 'end', 'comments', 'heredocs',
+                 'merged')
+
+    def __init__(self, command, args, start, end, comments):
+        """
+        Instantiates Instruction object
+        """
+        # upper case instruction (RUN, COPY...)
+        self.command = command
+        # everything after the instruction, with continuations joined
+        self.args = args
+        # first and last line of the instruction in the Dockerfile
+        self.start = start
+        self.end = end
+        # comment lines right above the instruction
+        self.comments = comments
+        # (delimiter, body) of each heredoc the instruction uses
+        self.heredocs = []
+        # how many instructions were coalesced into this one
+        self.merged = 1
+
+
+# <<EOF, <<-EOF, <<"EOF" and <<'EOF'
+heredoc_regex = re.compile(r'<<(-?)(["\']?)([a-zA-Z_][a-zA-Z0-9_]*)\2')
+# parser directives like # escape=`
+directive_regex = re.compile(r'#\s*(escape|syntax|check)\s*=\s*(\S*)\s*$',
+                             re.IGNORECASE)
+
+
+def tokenize_dockerfile(lines):
+    """
+    Yields an Instruction for each instruction in lines (a Dockerfile) in
+    a single pass. Handles the escape directive, escaped new lines,
+    comments (dropped inside of continued instructions) and heredocs of
+    RUN, COPY and ADD
+    """
+    escape = '\\'
+    directives = True  # directives are only allowed at the very top
+    comments = []
+    command = None  # set while an instruction is continued on next lines
+    parts = []
+    start = 0
+    instruction = None  # set while reading its heredocs
+    heredocs = []  # (strip tabs, delimiter) of heredocs still to read
+    body = []
+
+    for number, line in enumerate(lines, 1):
+        if instruction is not None:  # inside a heredoc
+            strip_tabs, delimiter = heredocs[0]
+            if strip_tabs:
+                line = line.lstrip('\t')
+            if line.rstrip('\r\n') != delimiter:
+                body.append(line)
+                continue
+            instruction.heredocs.append((delimiter, ''.join(body)))
+            instruction.end = number
+            body = []
+            del heredocs[0]
+            if len(heredocs) == 0:
+                yield instruction
+                instruction = None
+            continue
+
+        stripped = line.strip()
+        if directives:
+            match = directive_regex.match(stripped)
+            if match is not None:
+                if match.group(1).lower() == 'escape':
+                    escape = match.group(2)
+                continue
+            directives = False
+
+        if command is None:
+            if stripped == '':  # empty line ends a block of comments
+                del comments[:]
+                continue
+            if stripped.startswith('#'):
+                comments.append(stripped)
+                continue
+            split = stripped.split(None, 1)
+            command = split[0].upper()
+            start = number
+            stripped = split[1] if len(split) > 1 else ''
+        elif stripped == '' or stripped.startswith('#'):
+            continue  # Docker ignores these inside of an instruction
+
+        if stripped.endswith(escape):  # continued on the next line
+            parts.append(stripped[:-len(escape)])
+            continue
+        parts.append(stripped)
+
+        token = Instruction(command, ' '.join(' '.join(parts).split()),
+                            start, number, comments)
+        comments = []
+        command = None
+        parts = []
+        if token.command in ('RUN', 'COPY', 'ADD'):
+            for strip_tabs, _, delimiter in heredoc_regex.findall(token.args):
+                heredocs.append((strip_tabs == '-', delimiter))
+        if len(heredocs) > 0:
+            instruction = token
+        else:
+            yield token
+
+    # file ended in the middle of an instruction
+    if command is not None:
+        yield Instruction(command, ' '.join(' '.join(parts).split()),
+                          start, number, comments)
+    elif instruction is not None:
+        instruction.heredocs.append((heredocs[0][1], ''.join(body)))
+        yield instruction
+
+
+class Stage:
+    """
+    Stage Class
+    ----------------------------------------
+    One stage (FROM <image> [AS <name>]) of a Dockerfile
+    """
+    __slots__ = ('name', 'image', 'instructions', 'stages', 'images')
+
+    def __init__(self, name, image, instructions):
+        """
+        Instantiates Stage object
+        """
+        # name after AS (or the number of the stage)
+        self.name = name
+        # image of the FROM with the global ARGs filled in
+        self.image = image
+        # the instructions of the stage, starting with its FROM
+        self.instructions = instructions
+        # numbers of the stages it's built on or copies from
+        self.stages = []
+        # images it's built on or copies from
+        self.images = []
+
+
+# --flag=value options before the args of FROM, COPY and ADD
+flag_regex = re.compile(r'--([a-z-]+)(?:=(\S*))?(?:\s+|$)')
+
+
+def flags_split(args):
+    """
+    Returns ({flag: value}, args without the flags)
+    """
+    flags = {}
+    match = flag_regex.match(args)
+    while match is not None:
+        flags[match.group(1)] = match.group(2)
+        args = args[match.end():]
+        match = flag_regex.match(args)
+    return flags, args
+
+
+def split_stages(instructions):
+    """
+    Splits instructions into the ones before the first FROM (global ARGs)
+    and the Stages. The FROM images get the values of the global ARGs, and
+    a FROM or COPY --from that names an earlier stage (or its number)
+    becomes an edge to it
+    """
+    env = Environment()
+    preamble = []
+    stages = []
+    names = {}  # stage names and numbers -> stage numbers
+    for instruction in instructions:
+        if instruction.command == 'FROM':
+            words = flags_split(instruction.args)[1].split()
+            image = env.expand(words[0]) if len(words) > 0 else 'scratch'
+            name = str(len(stages))
+            if len(words) > 2 and words[1].upper() == 'AS':
+                name = words[2].lower()
+            stage = Stage(name, image, [instruction])
+            if image.lower() in names:
+                stage.stages.append(names[image.lower()])
+            else:
+                stage.images.append(image)
+            names[str(len(stages))] = names[name] = len(stages)
+            stages.append(stage)
+        elif len(stages) == 0:
+            preamble.append(instruction)
+            if instruction.command == 'ARG':
+                for arg in shlex.split(instruction.args):
+                    arg, equals, default = arg.partition('=')
+                    env.declare(arg, default if equals else None)
+        else:
+            stage = stages[-1]
+            stage.instructions.append(instruction)
+            source = flags_split(instruction.args)[0].get('from')
+            if instruction.command != 'COPY' or not source:
+                continue
+            source = env.expand(source)
+            if source.lower() in names:
+                stage.stages.append(names[source.lower()])
+            else:
+                stage.images.append(source)
+    return preamble, stages
+
+
+class Task:
+    """
+    Task Class
+    ----------------------------------------
+    One Ansible task made from a Dockerfile instruction
+    A task without a module is only its comments
+    """
+    __slots__ = ('name', 'module', 'args', 'keywords', 'environment',
+                 'comments', 'files')
+
+    def __init__(self, name, module, args, keywords=None):
+        """
+        Instantiates Task object
+        """
+        self.name = name
+        # ansible module (shell, copy...)
+        self.module = module
+        # free form string or dict of the module's args
+        self.args = args
+        # other keys of the task (with_fileglob...)
+        self.keywords = keywords if keywords is not None else {}
+        # environment vars the task needs
+        self.environment = {}
+        # comment lines to go above the task
+        self.comments = []
+        # path in the role dir (files/run.sh...) -> content of the files it
+        # needs there
+        self.files = {}
+
+    def strings(self):
+        """
+        Yields every string the task hands to ansible (to look for
+        environment vars in)
+        """
+        values = ([self.args] + list(self.keywords.values()) +
+                  list(self.files.values()))
+        while len(values) > 0:
+            value = values.pop(0)
+            if isinstance(value, str):
+                yield value
+            elif isinstance(value, dict):
+                values[0:0] = value.values()
+            elif isinstance(value, list):
+                values[0:0] = value
+
+    def to_dict(self):
+        """
+        Returns the task the way ansible sees it
+        """
+        task = {'name': self.name, self.module: self.args}
+        task.update(self.keywords)
+        if len(self.environment) > 0:
+            task['environment'] = self.environment
+        return task
+
+    def to_record(self):
+        """
+        Returns everything in the task as JSON-able values (see from_record)
+        """
+        return {'name': self.name, 'module': self.module, 'args': self.args,
+                'keywords': self.keywords, 'environment': self.environment,
+                'comments': self.comments, 'files': self.files}
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Returns the Task that to_record returned record for
+        """
+        task = cls(record['name'], record['module'], record['args'],
+                   record['keywords'])
+        task.environment = record['environment']
+        task.comments = record['comments']
+        task.files = record['files']
+        return task
+
+    def to_yaml(self):
+        """
+        Returns the lines of the task in a YAML list
+        """
+        lines = list(self.comments)
+        if self.module is None:
+            return lines
+        for key, value in self.to_dict().items():
+            key_lines = yaml_lines(key, value, 2)
+            if len(lines) == len(self.comments):  # first key starts item
+                key_lines[0] = '- ' + key_lines[0][2:]
+            lines.extend(key_lines)
+        return lines
+
+
+# plain YAML scalars that would be read as something other than a string
+yaml_reserved_regex = re.compile(
+    r'^(?:~|null|true|false|yes|no|on|off|y|n'
+    r'|[-+]?(?:[0-9][0-9_]*(?:\.[0-9_]*)?|\.[0-9]+)(?:e[-+]?[0-9]+)?'
+    r'|0x[0-9a-f]+|0o[0-7]+|[-+]?\.inf|\.nan|[0-9]+(?::[0-9]+)+'
+    r'|[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}.*)$', re.IGNORECASE)
+
+
+def yaml_scalar(value):
+    """
+    Returns value as a single line YAML scalar, quoted only if it has to be
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if (value == '' or value != value.strip() or
+            value[0] in '-?:,[]{}#&*!|>\'"%@`' or ': ' in value or
+            ' #' in value or value.endswith(':') or '\t' in value or
+            '\n' in value or yaml_reserved_regex.match(value)):
+        if '"' in value and "'" not in value and '\n' not in value:
+            return "'" + value + "'"
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def yaml_lines(key, value, indent):
+    """
+    Returns the lines of key: value in a YAML mapping indented by indent
+    """
+    spaces = ' ' * indent
+    if isinstance(value, dict):
+        lines = [spaces + key + ':']
+        for sub_key, sub_value in value.items():
+            lines.extend(yaml_lines(sub_key, sub_value, indent + 2))
+        return lines
+    if isinstance(value, list):
+        return [spaces + key + ':'] + [
+            spaces + '  - ' + yaml_scalar(item) for item in value]
+    if (isinstance(value, str) and '\n' in value.rstrip('\n') and
+            '\r' not in value and not value.endswith('\n\n')):
+        # multi line strings are literal blocks (the others are quoted,
+        # blocks can't keep \r or trailing empty lines)
+        header = '|'
+        if value.lstrip('\n')[0] == ' ':
+            header += '2'  # content is indented 2 more than the key
+        if not value.endswith('\n'):
+            header += '-'
+        return [spaces + key + ': ' + header] + [
+            spaces + '  ' + line if line != '' else ''
+            for line in value.rstrip('\n').split('\n')]
+    return [spaces + key + ': ' + yaml_scalar(value)]
+
+
+# VAR=val of an ENV line, val can have "quoted parts" and escaped chars
+env_pair_regex = re.compile(r'([^\s="]+)=((?:"[^"]*"|\\.|[^\s\\"])*)')
+# the quoted parts and escaped chars of an ENV val
+env_unquote_regex = re.compile(r'"([^"]*)"|\\(.)')
+# $VAR, ${VAR}, ${VAR:-default} and ${VAR:+alternative}
+env_reference_regex = re.compile(
+    r'\$(?:([a-zA-Z_][a-zA-Z0-9_]*)'
+    r'|\{([a-zA-Z_][a-zA-Z0-9_]*)(?::([-+])([^}]*))?\})')
+
+
+@functools.lru_cache(maxsize=4096)
+def env_references(line):
+    """
+    Returns line split by the vars it refers to: the text before the first
+    reference, then $VAR, VAR of ${VAR...}, operator, word and the text up
+    to the next reference for every reference
+    Cached since the same lines get looked at by several tasks
+    """
+    if '$' not in line:
+        return (line,)
+    return tuple(env_reference_regex.split(line))
+
+
+class Environment:
+    """
+    Environment Class
+    ----------------------------------------
+    Symbol table of the ENV vars and ARGs of a Dockerfile. ARGs before the
+    first FROM are global (only FROM lines can use them, unless a stage
+    declares them again), the others only last until the next FROM
+    """
+    def __init__(self):
+        """
+        Instantiates Environment object
+        """
+        # ENV vars of the current stage
+        self.env = {}
+        # ARGs before the first FROM
+        self.global_args = {}
+        # every var that has a value right now (looked up the most)
+        self.values = self.global_args
+        # false until the first FROM
+        self.in_stage = False
+
+    def stage(self):
+        """
+        Starts a new stage (FROM), which doesn't see the vars of the last
+        """
+        self.in_stage = True
+        self.env = {}
+        self.values = {}
+
+    def declare(self, arg, default=None):
+        """
+        ARG arg[=default]. A stage ARG without a default gets the value of
+        the global ARG
+        """
+        if not self.in_stage:
+            if default is not None:
+                self.global_args[arg] = default
+            return
+        if default is None:
+            default = self.global_args.get(arg)
+        if default is not None and arg not in self.env:
+            self.values[arg] = default
+
+    def set(self, var, value):
+        """
+        ENV var=value
+        """
+        self.env[var] = value
+        self.values[var] = value
+
+    def get(self, var):
+        """
+        Returns the value of var (ENV vars win over ARGs), None if unset
+        """
+        return self.values.get(var)
+
+    def resolve(self, var, operator, word):
+        """
+        Returns what one reference to var comes out as, None if var is
+        unset (and there's no default)
+        """
+        value = self.get(var)
+        if operator == '-':
+            return value if value else word
+        if operator == '+':
+            return word if value else ''
+        return value
+
+    def expand(self, line, strict=False):
+        """
+        Returns line with its references replaced by the values of the
+        vars. References to vars that aren't set are left alone, unless
+        strict, then None is returned (or if there is any other $ in line)
+        """
+        parts = env_references(line)
+        if strict and any('$' in text for text in parts[::5]):
+            return None
+        if len(parts) == 1:
+            return line
+        pieces = [parts[0]]
+        for x in range(1, len(parts), 5):
+            var, braced, operator, word, text = parts[x:x + 5]
+            value = self.resolve(var or braced, operator, word)
+            if value is None:
+                if strict:
+                    return None
+                elif var is not None:
+                    value = '$' + var
+                elif operator is None:
+                    value = '${' + braced + '}'
+                else:
+                    value = '${' + braced + ':' + operator + word + '}'
+            pieces.append(value)
+            pieces.append(text)
+        return ''.join(pieces)
+
+    def used(self, line):
+        """
+        Yields (var, value) of the vars that are set and used in line
+        """
+        parts = env_references(line)
+        values = self.values
+        for x in range(1, len(parts), 5):
+            var = parts[x] or parts[x + 1]
+            if var in values:
+                yield var, values[var]
+
+
+@functools.lru_cache(1024)
+def glob_regex(pattern):
+    """
+    Returns the compiled regex of a Docker path pattern, where * and ? don't
+    match a / (but ** matches any number of dirs)
+    """
+    regex = ''
+    x = 0
+    while x < len(pattern):
+        char = pattern[x]
+        if pattern.startswith('**', x):
+            regex += '.*'
+            x += 1
+        elif char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and ']' in pattern[x + 1:]:
+            end = pattern.index(']', x + 1)
+            chars = pattern[x + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):  # [!abc] is anything but abc
+                chars = '^' + chars[1:]
+            regex += '[' + chars + ']'
+            x = end
+        else:
+            regex += re.escape(char)
+        x += 1
+    return re.compile(regex + r'\Z')
+
+
+class BuildContext:
+    """
+    BuildContext Class
+    ----------------------------------------
+    Index of the files in a build context (the dir that the srcs of COPY
+    and ADD are relative to), made by one scan of it the first time it's
+    needed. What its .dockerignore leaves out isn't in it
+    """
+    def __init__(self, root, generated=()):
+        """
+        Instantiates BuildContext object
+        generated are the paths (or globs) that undockerize writes, which
+        are left out of its fingerprint when they are in root
+        """
+        self.root = root
+        # relative path -> number of files in it (1 for a file), None
+        # until it's scanned
+        self.paths = None
+        self.dirs = set()
+        self.lock = threading.Lock()
+        self.generated = []
+        for path in generated:
+            rel = os.path.relpath(path, root)
+            if rel != '..' and not rel.startswith('../'):
+                self.generated.append((glob_regex(rel), False))
+        # srcs -> hash of the paths they use (see fingerprint)
+        self.hashes = {}
+
+    def __getstate__(self):
+        """
+        Returns what gets pickled (for the parse processes), which is
+        everything but the lock
+        """
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Unpickles the BuildContext with a new lock
+        """
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def scan(self):
+        """
+        Indexes every file and dir under root (once)
+        """
+        with self.lock:
+            if self.paths is not None:
+                return
+            rules = self.ignore_rules()
+            paths = {'.': 0}
+            for dir_path, subdirs, files in os.walk(self.root):
+                subdirs.sort()
+                rel_dir = os.path.relpath(dir_path, self.root)
+                for name in subdirs + sorted(files):
+                    rel = os.path.normpath(os.path.join(rel_dir, name))
+                    if len(rules) > 0 and self.is_ignored(rel, rules):
+                        continue
+                    if name in subdirs:
+                        paths[rel] = 0
+                        self.dirs.add(rel)
+                        continue
+                    paths[rel] = 1
+                    # the dirs it's in hold one more file
+                    parent = os.path.dirname(rel)
+                    while parent != '':
+                        paths[parent] = paths.get(parent, 0) + 1
+                        parent = os.path.dirname(parent)
+                    paths['.'] += 1
+            self.paths = paths
+
+    def ignore_rules(self):
+        """
+        Returns the (regex, is an exception) of every line of .dockerignore
+        """
+        rules = []
+        try:
+            with open(os.path.join(self.root, '.dockerignore'), 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line == '' or line.startswith('#'):
+                        continue
+                    exception = line.startswith('!')
+                    pattern = os.path.normpath(line.lstrip('!').strip('/'))
+                    rules.append((glob_regex(pattern), exception))
+        except OSError:
+            pass
+        return rules
+
+    def is_ignored(self, rel, rules):
+        """
+        Returns true if the last rule that matches rel (or a dir it's in)
+        leaves it out
+        """
+        parts = rel.split('/')
+        prefixes = ['/'.join(parts[:x]) for x in range(1, len(parts) + 1)]
+        ignored = False
+        for regex, exception in rules:
+            if any(regex.match(prefix) for prefix in prefixes):
+                ignored = not exception
+        return ignored
+
+    def resolve(self, src):
+        """
+        Returns the relative paths of the files and dirs that src (a path
+        or a glob) matches, empty if nothing does
+        """
+        self.scan()
+        src = os.path.normpath(src.lstrip('/'))
+        if not any(char in src for char in '*?['):
+            return [src] if src in self.paths else []
+        regex = glob_regex(src)
+        return [rel for rel in self.paths if rel != '.' and regex.match(rel)]
+
+    def fingerprint(self, srcs=None):
+        """
+        Returns a hash of the paths that srcs (of COPYs and ADDs) match and
+        the paths in the dirs they match, every path in the context if
+        srcs is None (all the copy tasks depend on, not what's in the
+        files). What undockerize generates is left out
+        """
+        self.scan()
+        key = None if srcs is None else tuple(srcs)
+        with self.lock:
+            if key in self.hashes:
+                return self.hashes[key]
+        if srcs is None:
+            paths = set(self.paths)
+        else:
+            paths = set()
+            for src in srcs:
+                for rel in self.resolve(src):
+                    paths.add(rel)
+                    if self.is_dir(rel):
+                        prefix = '' if rel == '.' else rel + '/'
+                        paths.update(path for path in self.paths
+                                     if path.startswith(prefix))
+        sha = hashlib.sha256()
+        for rel in sorted(paths):
+            if rel != '.' and len(self.generated) > 0 and self.is_ignored(
+                    rel, self.generated):
+                continue
+            sha.update(rel.encode() + (b'/' if self.is_dir(rel) else b'')
+                       + b'\0')
+        with self.lock:
+            self.hashes[key] = sha.hexdigest()
+        return self.hashes[key]
+
+    def is_dir(self, rel):
+        """
+        Returns true if rel is a dir of the context
+        """
+        return rel == '.' or rel in self.dirs
+
+    def count(self, rel):
+        """
+        Returns how many files are in rel (1 if it's a file)
+        """
+        return self.paths.get(rel, 0)
 
 
 class Docker:
@@ -13,255 +720,421 @@ class Docker:
     ----------------------------------------
     Holds the Docker file info and parses it all
     """
-    def __init__(self, file_name, dir_str):
+    def __init__(self, file_name, dir_str, stage=None, native_packages=False,
+                 stats=None, tokens=None, context=None, synchronize=None,
+                 script_threshold=None, idempotent=False, env_file=False):
         """
-        Instantiates an array with all of the lines in the given docker file
+        Instantiates an array with all of the instructions of a stage
+        (the last one by default) in the given docker file
+        native_packages turns package installs into package module tasks
+        and stats is the Stats of the run (if it's being timed)
+        tokens are the (preamble, stages) of the file if it was already
+        read, which are never changed so that they can be used again
+        context is the BuildContext of the files (of dir_str by default)
+        and dirs of at least synchronize files are copied by synchronize
+        RUNs of at least script_threshold characters (and with heredocs)
+        become scripts in the files dir of the role if it's given
+        idempotent guards the shell tasks so they only run once
+        env_file puts the ENV vars in one profile.d file (with the role's
+        defaults) instead of a lineinfile task for each ENV
         """
         ########################
         #     instance vars    #
         ########################
-        # array of the lines in the dockerfile
-        self.docker_file = []
-        # array of converted file
-        self.ansible_file = ['---']
+        # array of the instructions in the dockerfile
+        self.instructions = []
+        # array of converted tasks (or Ansible object it streams to)
+        self.ansible_file = []
         # current working directory for ansible
         self.work_dir = '~/'
-        # the from line in the file
+        # the from line of the stage
         self.FROM = ''
+        # every Stage in the file and the number of the one to convert
+        self.stages = []
+        self.stage = -1
         # where the dependencies are located (root of Dockerfile)
         self.dir_str = dir_str
+        # index of the files that can be copied (where they are on disk)
+        self.context = context if context is not None else BuildContext(
+            dir_str)
+        self.synchronize = synchronize
         # holds comments until empty line or a command
         self.current_comments = []
-        # Dictionary of environment vars set throughout the script
-        self.all_env_vars = {}
+        # Symbol table of the environment vars (and ARGs) set so far
+        self.env = Environment()
+        # hash of the Dockerfile for the manifest (see Manifest.digest)
+        self.digest = None
+        # RUNs that only install packages become package module tasks
+        self.native_packages = native_packages
+        self.script_threshold = script_threshold
+        self.idempotent = idempotent
+        self.env_file = env_file
+        # ENV vars of the stage -> the values they end up with (env_file)
+        self.final_env = {}
+        # name of the role the tasks go in (set by the Conversion)
+        self.role = None
+        self.stats = stats if stats is not None else Stats()
         # different cases for the docker file syntax
         self.cases = {
                         'ADD': self.ADD,
+                        'ARG': self.ARG,
                         'COPY': self.COPY,
                         'ENV': self.ENV,
                         'RUN': self.RUN,
                         'WORKDIR': self.WORKDIR
                      }
-        # Read the file in and put the lines in the docker_file array
-        with open(file_name, 'r') as f:
-            for line in f:
-                line = line.strip()
-                self.docker_file.append(line)
-                split_line = line.split()
-                if len(split_line) > 0 and split_line[0] == 'FROM':
-                    self.FROM = line
-
-    def parse_docker(self):
+        # Read the file in and put the instructions of the stage (after
+        # the global ARGs) in the array
+        if tokens is None:
+            with self.stats.timer('tokenize'), open(file_name, 'r') as f:
+                tokens = split_stages(tokenize_dockerfile(f))
+        self.tokens = tokens
+        preamble, self.stages = tokens
+        self.instructions = list(preamble)
+        if len(self.stages) > 0:
+            self.stage = len(self.stages) - 1 if stage is None else stage
+            self.instructions += self.stages[self.stage].instructions
+            self.FROM = 'FROM ' + self.stages[self.stage].image
+
+    def needed_stages(self):
+        """
+        Returns the numbers of the stages that this stage is built on or
+        copies from (directly or not), in the order of the file. Stages
+        that nothing needs are left out
+        """
+        needed = set()
+        stages = [self.stage] if self.stage >= 0 else []
+        while len(stages) > 0:
+            stage = stages.pop()
+            if stage not in needed:
+                needed.add(stage)
+                stages += self.stages[stage].stages
+        needed.discard(self.stage)
+        return sorted(needed)
+
+    def coalesce_runs(self):
+        """
+        Merges consecutive RUN instructions into one, so that ansible only
+        needs one round trip for them. They share the work dir and env
+        vars since there is nothing in between them. Each command runs in
+        its own subshell (like each RUN gets its own shell) and the next
+        only runs if it succeeded
+        Returns how many instructions were removed
         """
-        Parses each line of docker to return the ansible file array
+        instructions = []
+        for instruction in self.instructions:
+            last = instructions[-1] if len(instructions) > 0 else None
+            if (last is not None and self.is_coalescable(last) and
+                    self.is_coalescable(instruction)):
+                if last.merged == 1:  # copy so the original stays the same
+                    merged = Instruction('RUN', '(' + last.args + ')',
+                                         last.start, last.end,
+                                         list(last.comments))
+                    instructions[-1] = last = merged
+                last.args += ' && (' + instruction.args + ')'
+                last.end = instruction.end
+                last.comments.extend(instruction.comments)
+                last.merged += 1
+            else:
+                instructions.append(instruction)
+        removed = len(self.instructions) - len(instructions)
+        self.instructions = instructions
+        return removed
+
+    def parse_docker(self, ansible_file=None):
         """
-        docker_file = self.docker_file
+        Parses each instruction of docker to return the array of Tasks
+        If an Ansible object is given, the tasks are streamed to it instead
+        """
+        if ansible_file is not None:
+            self.ansible_file = ansible_file
         ansible_file = self.ansible_file
-        current_comments = self.current_comments
         cases = self.cases
-
-        # Check each line for command, run cooresponding function
-        x = 0
-        while x < len(docker_file):
-            line_split = docker_file[x].split()
-            if len(line_split) > 0:
-                command = line_split[0]
-                if command in cases:
-                    # each function returns the next spot to go to
-                    # (handles multi-line commands)
-                    x = cases[command](x)
-                elif '#' in command:
-                    current_comments.append(docker_file[x])
-                elif 'FROM' not in command:
-                    # Append any unhandled commands as comments
-                    ansible_file.append(
-                        '# *****UNDOCKERIZE*****: !!MISSING COMMAND!!: '
-                        + docker_file[x])
-            else:  # must be empty line
-                del current_comments[:]
-            x += 1
-        del self.ansible_file[-1]  # remove the last \n
+        stats = self.stats
+        if self.env_file:
+            self.final_env = self.ENV_final_helper()
+
+        # Check each instruction, run cooresponding function
+        for instruction in self.instructions:
+            if stats.enabled:
+                start = time.perf_counter()
+            self.current_comments = list(instruction.comments)
+            command = instruction.command
+            if command in cases:
+                cases[command](instruction)
+            elif command == 'FROM':
+                self.env.stage()
+                self.comments()
+            else:
+                # Append any unhandled commands as comments
+                self.current_comments.append(
+                    '# *****UNDOCKERIZE*****: !!MISSING COMMAND!!: '
+                    + command + ' ' + instruction.args)
+                self.comments()
+            if stats.enabled:
+                stats.add_time('handle ' + command,
+                               time.perf_counter() - start)
 
     """----------------------COMMANDS------------------"""
-    def ADD(self, x):
+    def ADD(self, instruction):
         """
         Logic for an ADD command (Can copy, download from remote, or unarchive)
         """
-        add_cmd, new_x = self.condense_multiline_cmds(x)
-        if self.is_square_brackets(add_cmd):
-            srcs, dest = self.square_brackets_split(add_cmd)
-        else:
-            split = add_cmd.split()
-            srcs = split[:-1]
-            dest = split[-1]
+        if len(instruction.heredocs) > 0:  # same as COPY for heredocs
+            return self.COPY(instruction)
+        flags, srcs, dest = self.copy_split(instruction.args)
 
         if self.is_relative_path(dest):
-            dest = self.work_dir + '/' + dest
+            dest = self.work_dir_path(dest)
         for src in srcs:
-            cmd, _type = self.ADD_helper(src, dest)
-            name = self.ADD_name_helper(_type, src, dest)
-            self.put_together('ADD', name=name, cmd=cmd)
-        return new_x
+            if self.is_url(src) or self.is_tar(src):
+                task, _type = self.ADD_helper(src, dest)
+                task.name = self.ADD_name_helper(_type, src, dest)
+                tasks = [task]
+            else:  # same as a COPY
+                tasks = self.COPY_helper([src], dest, flags)
+            for task in tasks:
+                self.flags_helper(task, flags)
+                self.put_together('ADD', task)
+
+    def ARG(self, instruction):
+        """
+        Logic for an ARG command (Declares build args). Build args aren't
+        kept in the image, so they only go in the environment of the tasks
+        that use them
+        """
+        self.ARG_helper(self.env, instruction.args)
+        self.comments()
 
-    def COPY(self, x):
+    def COPY(self, instruction):
         """
         Logic for a COPY command (Copies file to another location)
         """
-        docker_cp_cmd, new_x = self.condense_multiline_cmds(x)
-        if self.is_square_brackets(docker_cp_cmd):
-            srcs, dest = self.square_brackets_split(docker_cp_cmd)
-        else:
-            split = docker_cp_cmd.split()
-            srcs = split[:-1]
-            dest = split[-1]
+        flags, srcs, dest = self.copy_split(instruction.args)
         if self.is_relative_path(dest):
-            dest = self.work_dir + '/' + dest
-        cmd = self.COPY_helper(srcs, dest)
-        name = self.COPY_name_helper(srcs, dest)
-        self.put_together('COPY', name=name, cmd=cmd)
-        return new_x
+            dest = self.work_dir_path(dest)
+
+        # heredocs are files with the body as their content
+        heredocs = dict(instruction.heredocs)
+        files = []
+        for src in srcs:
+            match = heredoc_regex.match(src)
+            if match is not None and match.group(3) in heredocs:
+                content = heredocs[match.group(3)]
+                file_dest = dest
+                if dest.endswith('/'):
+                    file_dest = dest + match.group(3)
+                task = Task('Write ' + file_dest, 'copy',
+                            {'dest': file_dest, 'content': content})
+                self.flags_helper(task, flags)
+                self.put_together('COPY', task)
+            else:
+                files.append(src)
+        if len(files) == 0:
+            return
+
+        if flags.get('from'):  # made by another stage (or image)
+            source = self.env.expand(flags['from'])
+            task = self.COPY_from_helper(files, dest)
+            task.name = (self.COPY_name_helper(files, dest) + ' from ' +
+                         source)
+            tasks = [task]
+        else:
+            tasks = self.COPY_helper(files, dest, flags)
+        for task in tasks:
+            self.flags_helper(task, flags)
+            self.put_together('COPY', task)
 
-    def ENV(self, x):
+    def ENV(self, instruction):
         """
         Logic for a ENV command (Sets environment variables)
         """
-        env_cmd, new_x = self.condense_multiline_cmds(x)
-        env_vars, spaced = self.ENV_helper(env_cmd)
-
-        # Add the env vars to the dictionary
-        _vars, _vals = self.ENV_parser(env_vars)
-        for x in range(0, len(_vars)):
-            # Replace other env vars with the values if set above them
-            # ex: Replace $TEST with the value of $TEST
-            other_env_vars = self.find_env_vars(_vals[x])
-            for _var in other_env_vars:
-                val_of_other_var = self.all_env_vars.get(_var)
-                if val_of_other_var is not None:
-                    _vals[x] = _vals[x].replace('$' + _var, val_of_other_var)
-            # Save to the dictionary
-            self.all_env_vars[_vars[x]] = _vals[x]
-
-        cmd = []
-        cmd.append('  lineinfile:')
-        cmd.append('    dest: ~/.bashrc')
-        cmd.append("    line: 'export "+env_vars+"'")
-        name = self.ENV_name_helper(env_vars, spaced)
-        self.put_together('ENV', name=name, cmd=cmd)
-        return new_x
-
-    def RUN(self, x):
+        env_cmd = instruction.args
+        env_vars = self.ENV_helper(env_cmd)
+        first = len(self.env.env) == 0
+        _vars = self.ENV_set_helper(self.env, env_vars)
+        if self.env_file:  # the first ENV writes them all
+            if first:
+                self.ENV_file_helper()
+            else:
+                self.comments()
+            return
+
+        name = self.ENV_name_helper(_vars)
+        task = Task(name, 'lineinfile',
+                    {'dest': '~/.bashrc', 'line': 'export ' + env_vars})
+        self.put_together('ENV', task)
+
+    def RUN(self, instruction):
         """
         Logic for a RUN command (Shell command)
         """
-        shell_cmd, new_x = self.condense_multiline_cmds(x)
-        cmd = '  shell: '+self.get_work_dir_cmd()
-        cmd += shell_cmd
+        shell_cmd = instruction.args
+        if len(instruction.heredocs) > 0:
+            shell_cmd = self.RUN_heredoc_helper(instruction)
         name = 'Shell Command (' + ' '.join(shell_cmd.split()[0:5]) + ')'
-        self.put_together('RUN', name=name, cmd=[cmd])
-        return new_x
+        if instruction.merged > 1:
+            first = shell_cmd[1:].split(') && (')[0]
+            name = ('Shell Commands (' + ' '.join(first.split()[0:5]) +
+                    ' + ' + str(instruction.merged - 1) + ' more)')
+        elif self.native_packages and len(instruction.heredocs) == 0:
+            tasks = self.RUN_package_helper(shell_cmd)
+            if tasks is not None:
+                for task in tasks:
+                    self.put_together('RUN', task)
+                return
+        if self.is_script(instruction, shell_cmd):
+            task = self.RUN_script_helper(instruction, shell_cmd)
+            task.name = name
+        elif self.idempotent:
+            task = self.RUN_guard_helper(shell_cmd)
+            task.name = name
+        else:
+            task = Task(name, 'shell', self.get_work_dir_cmd() + shell_cmd)
+        self.put_together('RUN', task)
 
-    def WORKDIR(self, x):
+    def WORKDIR(self, instruction):
         """
         Logic for a WORKDIR command (change dir for next commands)
         Supposed to work for RUN, CMD, ENTRYPOINT, COPY, ADD
         """
-        _dir, new_x = self.condense_multiline_cmds(x)
+        _dir = instruction.args
         if self.is_relative_path(_dir):
-            self.work_dir += '/' + _dir
+            self.work_dir = self.work_dir_path(_dir)
         else:
             self.work_dir = _dir
         name = 'Working dir- ' + self.work_dir
-        cmd = '  shell: mkdir -p ' + self.work_dir
-        self.put_together('WORKDIR', name=name, cmd=[cmd])
-        return new_x
+        path = None
+        if self.idempotent:
+            path = self.expand_env_vars(self.work_dir)
+        if path is not None:
+            task = Task(name, 'file', {'path': path, 'state': 'directory'})
+        else:
+            task = Task(name, 'shell', 'mkdir -p ' + self.work_dir)
+        self.put_together('WORKDIR', task)
 
     """----------------COMMAND HELPER FUNCTIONS--------------"""
     def ADD_helper(self, src, dest):
         """
-        Determines if you need to get from remote location,
-        unarchive a tar, or just copy and returns the cmd,
+        Determines if you need to get from remote location or
+        unarchive a tar and returns the Task,
         along with what type it was for naming later
+        (anything else is a copy, see COPY_helper)
         """
         if self.is_url(src):
-            cmd = []
-            cmd.append('  get_url:')
-            cmd.append('    url: ' + src)
-            cmd.append('    dest: ' + dest)
-            return cmd, 'url'
-        elif self.is_tar(src):
-            cmd = []
-            cmd.append('  unarchive:')
-            cmd.append('    src: ' + src)
-            cmd.append('    dest: ' + dest)
-            return cmd, 'tar'
-        else:
-            return self.COPY_helper([src], dest), 'copy'
+            return Task(None, 'get_url', {'url': src, 'dest': dest}), 'url'
+        return Task(None, 'unarchive', {'src': src, 'dest': dest}), 'tar'
 
     def ADD_name_helper(self, _type, src, dest):
         """
-        Returns name based on if getting from url, unarchiving, or copying
+        Returns name based on if getting from url or unarchiving
         """
         if _type == 'url':
             return 'Download file from ' + src + ' to ' + dest
-        elif _type == 'copy':
-            return self.COPY_name_helper([src], dest)
         elif _type == 'tar':
             return 'Unarchive ' + src + ' to ' + dest
 
     def comments(self):
         """
-        Appends the current_comments to the ansible file
+        Appends the current_comments to the ansible file (as a Task that is
+        only comments)
         """
-        ansible_file = self.ansible_file
         comments = self.current_comments
 
         if len(comments) > 0:
-            for comment in comments:
-                ansible_file.append(comment)
+            task = Task(None, None, None)
+            task.comments = list(comments)
+            self.ansible_file.append(task)
             del comments[:]
 
-    def condense_multiline_cmds(self, x):
+    def COPY_helper(self, srcs, dest, flags=None):
         """
-        Account for backslashes to condense multiline command into one line
+        COPY allows for COPY <src> <src>... <dest>
+        The srcs are looked up in the BuildContext: globs become the files
+        they match, and each dir gets copied whole (by synchronize if it
+        has at least --synchronize files and no --chown/--chmod)
+        Returns the copy Tasks (the one of the files first)
         """
-        docker_file = self.docker_file
-
-        line = ''
-        while True:  # breaks after there are no more escaped new lines
-            line_split = docker_file[x].split()
-            if line_split[0] in self.cases:  # Remove cases from split
-                line_split = line_split[1:]
-            if '#' in line_split[0]:  # ignore comments
-                x += 1
-            elif line_split[len(line_split)-1] == '\\':  # Has backslash
-                # Only add if there is more than just a backslash
-                if len(line_split) > 1:
-                    line += ' '.join(line_split[:len(line_split)-1]) + ' '
-                x += 1
-            else:  # End of a statement
-                line += ' '.join(line_split)
-                break
-        return line, x
+        files = []
+        file_srcs = []
+        tasks = []
+        for src in srcs:
+            expanded = src
+            if '$' in src:
+                expanded = self.expand_env_vars(src) or src
+            expanded = expanded.replace('\\ ', ' ')  # bracket form
+            matches = self.context.resolve(expanded)
+            if len(matches) == 0:
+                logger.warning('Possible copy issue with file:' +
+                               self.src_path(expanded))
+                matches = [os.path.normpath(expanded.lstrip('/'))]
+            for match in matches:
+                if not self.context.is_dir(match):
+                    files.append(self.src_path(match))
+                    if src not in file_srcs:
+                        file_srcs.append(src)
+                    continue
+                # a dir copies what's in it
+                src_dir = self.src_path(match).rstrip('/') + '/'
+                if (self.synchronize is not None and
+                        self.context.count(match) >= self.synchronize and
+                        not (flags or {}).get('chown') and
+                        not (flags or {}).get('chmod')):
+                    task = Task(None, 'synchronize',
+                                {'src': src_dir, 'dest': dest})
+                else:
+                    task = Task(None, 'copy',
+                                {'src': src_dir, 'dest': dest,
+                                 'mode': '0744'})
+                task.name = self.COPY_name_helper([src], dest)
+                tasks.append(task)
+        if len(files) == 1:
+            task = Task(None, 'copy',
+                        {'src': files[0], 'dest': dest, 'mode': '0744'})
+        elif len(files) > 1:
+            task = Task(None, 'copy',
+                        {'src': '{{item}}', 'dest': dest, 'mode': '0744'},
+                        {'with_items': files})
+        if len(files) > 0:
+            task.name = self.COPY_name_helper(file_srcs, dest)
+            tasks.insert(0, task)
+        return tasks
+
+    def COPY_from_helper(self, srcs, dest):
+        """
+        COPY --from=<stage> copies files that the role of the stage made,
+        which are already on the host since that role runs first
+        Returns the copy Task
+        """
+        if len(srcs) == 1:
+            return Task(None, 'copy',
+                        {'src': srcs[0], 'dest': dest, 'remote_src': True})
+        return Task(None, 'copy',
+                    {'src': '{{item}}', 'dest': dest, 'remote_src': True},
+                    {'with_items': list(srcs)})
+
+    def src_path(self, rel):
+        """
+        Returns the path the tasks copy rel (relative to the context) from
+        """
+        if rel == '.':
+            return self.dir_str
+        if self.dir_str == '.':
+            return rel
+        return self.dir_str + '/' + rel
 
-    def COPY_helper(self, srcs, dest):
+    def copy_split(self, args):
         """
-        COPY allows for COPY <src> <src>... <dest>
-        Checks for copying multiple files at once
-        Returns the copy command
+        Splits the args of a COPY or ADD into its flags, srcs and dest
         """
-        cmd = []
-        cmd.append('  copy:')
-        cmd.append('    src: "{{item}}"')
-        cmd.append('    dest: ' + dest)
-        cmd.append('    mode: 0744')
-        cmd.append('  with_fileglob:')
-        for src in srcs:  # add all sources to fileglob
-            if not os.path.exists(src):
-                src = self.dir_str + '/' + src
-                if not os.path.isfile(src):
-                    print('WARNING: Possible copy issue with file:' + src)
-            cmd.append('    - ' + src)
-        return cmd
+        flags, cmd = flags_split(args)
+        if self.is_square_brackets(cmd):
+            srcs, dest = self.square_brackets_split(cmd)
+        else:
+            split = cmd.split()
+            srcs = split[:-1]
+            dest = split[-1]
+        return flags, srcs, dest
 
     def COPY_name_helper(self, srcs, dest):
         """
@@ -280,80 +1153,117 @@ class Docker:
         if '=' not in line_split[0]:
             var = line_split[0]
             val = ' '.join(line_split[1:])
-            return ''.join(var + '="' + val + '"'), True
+            return var + '="' + val + '"'
         else:  # uses ENV equals assignment, already good
-            return line, False
+            return line
 
-    def ENV_name_helper(self, env_vars, spaced):
+    def ENV_set_helper(self, env, env_vars):
         """
-        Returns name with all ENV vars in title
+        Adds the vars of a VAR=val ENV line to the env symbol table
+        Values use the vars as they were before this ENV
+        ex: Replace $TEST with the value of $TEST
+        Returns the names of the vars
+        """
+        _vars, _vals = self.ENV_parser(env_vars)
+        _vals = [env.expand(_val) for _val in _vals]
+        for _var, _val in zip(_vars, _vals):
+            env.set(_var, _val)
+        return _vars
+
+    def ENV_final_helper(self):
+        """
+        Returns the ENV vars of the stage with the values they have at the
+        end of it (what the profile.d file of env_file exports)
+        """
+        env = Environment()
+        for instruction in self.instructions:
+            if instruction.command == 'FROM':
+                env.stage()
+            elif instruction.command == 'ARG':
+                self.ARG_helper(env, instruction.args)
+            elif instruction.command == 'ENV':
+                self.ENV_set_helper(env, self.ENV_helper(instruction.args))
+        return env.env
+
+    def ENV_role_var(self):
+        """
+        Returns the name of the role default with the ENV vars (env_file)
+        """
+        return re.sub(r'\W', '_', self.role or 'UnDockerized') + '_environment'
+
+    def ENV_file_helper(self):
+        """
+        Adds the template task of /etc/profile.d/<role>.sh, which exports
+        the ENV vars of the stage (with their last values) from the
+        <role>_environment default of the role
+        """
+        role = self.role or 'UnDockerized'
+        role_var = self.ENV_role_var()
+        task = Task(self.ENV_name_helper(list(self.final_env)), 'template',
+                    {'src': 'environment.sh.j2',
+                     'dest': '/etc/profile.d/' + role + '.sh',
+                     'mode': '0644'})
+        # double quotes so that vars that aren't ENVs ($PATH) still expand
+        task.files['templates/environment.sh.j2'] = (
+            '# ENV vars of the ' + role + ' role\n'
+            '{% for var, value in ' + role_var + '.items() %}\n'
+            'export {{ var }}="{{ value | replace(\'\\\\\', \'\\\\\\\\\') '
+            '| replace(\'"\', \'\\\\"\') }}"\n'
+            '{% endfor %}\n')
+        task.files['defaults/main.yml'] = '\n'.join(
+            ['---'] + yaml_lines(role_var, dict(self.final_env), 0)) + '\n'
+        self.put_together('ENV', task)
+
+    def ARG_helper(self, env, args):
+        """
+        Declares the build args of an ARG line in the env symbol table
+        """
+        for arg in shlex.split(args):
+            arg, equals, default = arg.partition('=')
+            env.declare(arg, default if equals else None)
 
-        regex explanation:
-        ([a-zA-Z0-9_]+)=# capture something with one or more env allowed chars followed by =
-        The rest is to make sure that the above capture isn't surrounded with quotes
-        Found at: https://stackoverflow.com/questions/15464299/regex-expression-to-match-even-number-of-double-quotation-not-match-single-o
-        (?=              #Only if the following regex matches
-        (?:              #match
-        [^"]*"           #Any number of quotes followed by a quotes
-        [^"]*"           #Again to make sure even number of quotes
-        )*               #as many times as needed
-        [^"]*$)          #match the remaining non-quote characters until the end of the string
-        """  # NOQA
-        regex = r'([a-zA-Z0-9_]+)=(?=(?:[^"]*"[^"]*")*[^"]*$)'
-        found_vars = re.findall(regex, env_vars)
-        return 'Set ENV vars- ' + ' '.join(found_vars)
+    def ENV_name_helper(self, _vars):
+        """
+        Returns name with all ENV vars in title
+        """
+        return 'Set ENV vars- ' + ' '.join(_vars)
 
     def ENV_parser(self, env_vars):
         """
-        Straight Hell incarniate
-        This function hopefully takes an export ENV command and splits it
-        into variables and values
+        Splits a VAR=val ENV line into the variables and their values
+        (without the quotes and backslashes)
         """
-        env_vars += ' '  # add space at end so everything will append
-        open_quote = False
-        last_backslash = False
-        is_var = True
         _vars = []
         _vals = []
-
-        word = ''
-        for char in env_vars:
-            if is_var and char == '=':  # end of a var
-                _vars.append(word)
-                word = ''
-                is_var = False
-            elif is_var and char != ' ':
-                word += char
-            elif is_var:  # must be space between val and var
-                continue
-            # everything after this is a value
-            elif char == '"':
-                open_quote = not open_quote
-                if open_quote is False:
-                    _vals.append(word)
-                    word = ''
-                    is_var = True
-            elif open_quote:
-                word += char
-            # everything after this is not in quotes
-            elif char == '\\' and not last_backslash:
-                last_backslash = True
-            elif last_backslash:  # escaped char
-                word += char
-                last_backslash = False
-            elif char == ' ':  # space but not escaped
-                _vals.append(word)
-                word = ''
-                is_var = True
-            else:  # add every other char
-                word += char
+        for _var, _val in env_pair_regex.findall(env_vars):
+            _vars.append(_var)
+            if '"' in _val or '\\' in _val:
+                _val = env_unquote_regex.sub(
+                    lambda quoted: quoted.group(1) or quoted.group(2) or '',
+                    _val)
+            _vals.append(_val)
         return _vars, _vals
 
-    def find_env_vars(self, cmd):
+    def expand_env_vars(self, word):
+        """
+        Replaces $VAR, ${VAR} and ${VAR:-default} in word with the values
+        of the env vars
+        Returns None if word uses a var that isn't set
+        """
+        return self.env.expand(word, strict=True)
+
+    def flags_helper(self, task, flags):
         """
-        Regex expression to find env variables
+        Adds what the --chown and --chmod flags of COPY/ADD set to the
+        args of task
         """
-        return re.findall(r'[$]([a-zA-Z0-9_]+)', cmd)
+        if flags.get('chown'):
+            owner, _, group = flags['chown'].partition(':')
+            task.args['owner'] = owner
+            if group != '':
+                task.args['group'] = group
+        if flags.get('chmod'):
+            task.args['mode'] = flags['chmod']
 
     def get_work_dir_cmd(self):
         """
@@ -365,11 +1275,60 @@ class Docker:
         else:
             return ''
 
+    def is_coalescable(self, instruction):
+        """
+        Returns true if instruction is a RUN that can be merged with
+        another (not exec form, no heredocs, no # that could start a
+        shell comment and swallow the commands after it, and not one that
+        becomes package module tasks)
+        """
+        return (instruction.command == 'RUN' and
+                len(instruction.heredocs) == 0 and
+                not instruction.args.startswith('[') and
+                '#' not in instruction.args and
+                not (self.native_packages and self.RUN_package_helper(
+                    instruction.args, True) is not None))
+
+    def is_cleanup(self, cmd):
+        """
+        Returns true if cmd only deletes package manager caches, which only
+        matters for the size of an image
+        """
+        caches = ('/var/lib/apt/lists/', '/var/cache/apt/', '/var/cache/apk/',
+                  '/var/cache/yum', '/var/cache/dnf', '/root/.cache/pip',
+                  '/tmp/')
+        paths = [word for word in cmd[1:] if not word.startswith('-')]
+        return (cmd[0] == 'rm' and len(paths) > 0 and
+                all(path.startswith(caches) for path in paths))
+
+    def is_script(self, instruction, shell_cmd):
+        """
+        Returns true if a RUN should become a script: a heredoc with its own
+        #! interpreter, or (with script_threshold) one that is at least
+        script_threshold characters or uses heredocs (but not in exec form)
+        """
+        if len(instruction.heredocs) > 0 and shell_cmd.startswith('#!'):
+            return True
+        if self.script_threshold is None or self.is_square_brackets(
+                instruction.args):
+            return False
+        if len(instruction.heredocs) > 0:
+            return True
+        return len(shell_cmd) >= self.script_threshold
+
     def is_relative_path(self, path):
         """
         Returns true if path doesn't start with '/' or ~ (must be relative)
+        once its env vars are expanded ($HOME_DIR can be absolute)
         """
-        return path[0] != '/' and path[0] != '~'
+        path = self.env.expand(path)
+        return path[:1] != '/' and path[:1] != '~'
+
+    def work_dir_path(self, path):
+        """
+        Returns the relative path in the work dir
+        """
+        return self.work_dir.rstrip('/') + '/' + path
 
     def is_square_brackets(self, cmd):
         """
@@ -393,37 +1352,310 @@ class Docker:
         """
         return urllib.parse.urlparse(url).scheme != ""
 
-    def put_together(self, _type, name, cmd):
+    def put_together(self, _type, task):
         """
         The common stuff of every command
-        Adds the comments above, then the name and
-        command lines to the ansible_file array
+        Adds the comments above and the environment vars the task
+        uses, then appends it to the ansible_file array
         """
-        ansible_file = self.ansible_file
+        task.comments = list(self.current_comments)
+        del self.current_comments[:]
+        if _type != 'ENV':
+            for line in task.strings():
+                # env_var stuff
+                for _var, _val in self.env.used(line):
+                    if _var not in task.environment:
+                        # ansible doesn't handle tildes for env vars
+                        # correctly without filter
+                        if '~' in _val:
+                            _val = '{{ "' + _val + '" | expanduser }}'
+                        task.environment[_var] = _val
+            # with env_file the role's ENV vars are used if they are the
+            # ones the task needs, and none of them uses a var that isn't
+            # set (PATH=/opt/bin:$PATH, which ansible wouldn't expand)
+            if (self.env_file and len(task.environment) > 0 and
+                    task.environment == self.final_env and
+                    not any('$' in _val for _val in self.final_env.values())):
+                task.environment = '{{ ' + self.ENV_role_var() + ' }}'
+        self.ansible_file.append(task)
+
+    def RUN_package_helper(self, shell_cmd, any_vars=False):
+        """
+        If shell_cmd only updates/installs packages with apt-get, yum, dnf,
+        apk or pip (and cleans up after them), returns a Task with the
+        ansible module of each package manager, all of its packages in
+        one call. Returns None if there is anything else in shell_cmd
+        any_vars takes the vars in package names to be set (to tell if it
+        would be converted before the ENVs are parsed)
+        """
+        try:
+            lexer = shlex.shlex(shell_cmd, posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            words = list(lexer)
+        except ValueError:  # unbalanced quotes
+            return None
+
+        # split into the commands chained by && or ;
+        cmds = [[]]
+        for word in words:
+            if word in ('&&', ';'):
+                cmds.append([])
+            elif all(char in lexer.punctuation_chars for char in word):
+                return None  # pipes, redirects, subshells...
+            else:
+                cmds[-1].append(word)
+
+        packages = {}  # module -> args, in the order they are used
+        for cmd in cmds:
+            # VAR=val before a command only matters for the command
+            while len(cmd) > 0 and re.match(r'[a-zA-Z_][a-zA-Z0-9_]*=',
+                                            cmd[0]):
+                cmd = cmd[1:]
+            if len(cmd) == 0 or cmd[0] == 'set' or self.is_cleanup(cmd):
+                continue
+            if not self.package_cmd_helper(cmd, packages, any_vars):
+                return None
+        if len(packages) == 0:
+            return None
+
+        tasks = []
+        for module, args in packages.items():
+            if 'name' in args:
+                name = ('Install ' + module + ' packages- ' +
+                        ' '.join(args['name']))
+            else:
+                name = 'Update ' + module + ' cache'
+            tasks.append(Task(name, module, args))
+        return tasks
+
+    def package_cmd_helper(self, cmd, packages, any_vars=False):
+        """
+        Adds what one package manager command does to the args of its
+        module in packages (words with vars are left as they are if
+        any_vars)
+        Returns false if it isn't a command that can be converted
+        """
+        manager = cmd[0]
+        options = [word for word in cmd[1:] if word.startswith('-')]
+        words = [word for word in cmd[1:] if not word.startswith('-')]
+        if len(words) == 0:
+            return False
+        sub_cmd = words[0]
+        names = []
+        for word in words[1:]:
+            if not any_vars:
+                word = self.expand_env_vars(word)
+            if word is None:  # a var that isn't set
+                return False
+            # a var can hold more than one package (ENV PKGS="a b")
+            for name in word.split():
+                # anything but a package name (options, paths, globs)
+                if re.search(r'[/*?\[\]]', name) or name[0] == '-' or \
+                        name == '.':
+                    return False
+                names.append(name)
+
+        if manager in ('apt-get', 'apt'):
+            allowed = ('-y', '--yes', '--assume-yes', '-q', '-qq',
+                       '--quiet', '--no-install-recommends')
+            args = packages.setdefault('apt', {})
+            if sub_cmd == 'update' and len(names) == 0:
+                args['update_cache'] = True
+                args['cache_valid_time'] = 3600
+            elif sub_cmd == 'install' and len(names) > 0:
+                args.setdefault('name', []).extend(names)
+                if '--no-install-recommends' in options:
+                    args['install_recommends'] = False
+            elif sub_cmd not in ('clean', 'autoclean') or len(names) > 0:
+                return False
+        elif manager in ('yum', 'dnf'):
+            allowed = ('-y', '--assumeyes', '-q', '--quiet')
+            args = packages.setdefault(manager, {})
+            if sub_cmd == 'makecache' and len(names) == 0:
+                args['update_cache'] = True
+            elif sub_cmd == 'install' and len(names) > 0:
+                args.setdefault('name', []).extend(names)
+            elif sub_cmd != 'clean':
+                return False
+        elif manager == 'apk':
+            allowed = ('--no-cache', '--update', '-U', '--update-cache',
+                       '-q', '--quiet')
+            args = packages.setdefault('apk', {})
+            if sub_cmd == 'update' and len(names) == 0:
+                args['update_cache'] = True
+            elif sub_cmd == 'add' and len(names) > 0:
+                args.setdefault('name', []).extend(names)
+                if len(options) > 0 and options != ['-q']:
+                    args['update_cache'] = True  # all but -q update
+            else:
+                return False
+        elif manager in ('pip', 'pip3'):
+            allowed = ('--no-cache-dir', '-q', '--quiet', '-U', '--upgrade',
+                       '--disable-pip-version-check')
+            if sub_cmd != 'install' or len(names) == 0:
+                return False
+            args = packages.setdefault('pip', {})
+            args.setdefault('name', []).extend(names)
+            if manager == 'pip3':
+                args['executable'] = 'pip3'
+            if '-U' in options or '--upgrade' in options:
+                args['state'] = 'latest'
+        else:
+            return False
+        return all(option in allowed for option in options)
 
-        self.comments()
-        ansible_file.append('- name: ' + name)
-        need_env_vars = {}
-        need_environment = False
-        for line in cmd:
-            ansible_file.append(line)
-            # env_var stuff
-            poss_vars = self.find_env_vars(line)
-            for _var in poss_vars:
-                poss = self.all_env_vars.get(_var)
-                if poss is not None and need_env_vars.get(_var) is None:
-                    need_env_vars[_var] = poss
-                    if not need_environment:
-                        need_environment = True
-        if need_environment and _type != 'ENV':
-            ansible_file.append('  environment:')
-            for _var, _val in need_env_vars.items():
-                # ansible doesn't handle tildes for env vars correctly
-                # without filter
-                if '~' in _val:
-                    _val = '{{ "' + _val + '" | expanduser }}'
-                ansible_file.append('    ' + _var + ': ' + _val)
-        ansible_file.append('')  # New line after command
+    def RUN_script_helper(self, instruction, shell_cmd):
+        """
+        Returns the script Task of a RUN, with the script in its files.
+        The script runs the command in a subshell (in the work dir) and
+        then touches a stamp named by the hash of the command and the env
+        vars it uses, so it's skipped once it has succeeded (creates)
+        A heredoc with its own #! interpreter is the script as it is, run
+        in the work dir by the module (chdir), without a stamp
+        """
+        if shell_cmd.startswith('#!'):
+            digest = self.stamp_digest(shell_cmd)
+            script_name = 'run_%d_%s.sh' % (instruction.start, digest[:10])
+            task = Task(None, 'script', {'cmd': script_name})
+            if self.work_dir != '~/':
+                work_dir = self.expand_env_vars(self.work_dir)
+                task.args['chdir'] = work_dir or self.work_dir
+            task.files['files/' + script_name] = shell_cmd
+            self.stats.count('scripts extracted')
+            return task
+        body = '(\n' + self.get_work_dir_cmd() + shell_cmd.rstrip('\n') + (
+            '\n) || exit\n')
+        digest = self.stamp_digest(body)
+        script_name = 'run_%d_%s.sh' % (instruction.start, digest[:10])
+        task = Task(None, 'script', {'cmd': script_name,
+                                     'creates': '~/.undockerize/' + digest})
+        task.files['files/' + script_name] = (
+            '#!/bin/sh\n' + body + 'mkdir -p "$HOME/.undockerize" && '
+            'touch "$HOME/.undockerize/' + digest + '"\n')
+        self.stats.count('scripts extracted')
+        return task
+
+    def RUN_guard_helper(self, shell_cmd):
+        """
+        Returns the shell Task of a RUN that only runs until it succeeds:
+        creates is what its last command downloads or unzips if it's one
+        of those, otherwise a stamp that it touches once it has succeeded
+        (named by the hash of the command and the env vars it uses)
+        """
+        cmd = self.get_work_dir_cmd() + shell_cmd
+        creates = self.creates_path(shell_cmd)
+        if creates is None:
+            digest = self.stamp_digest(cmd)
+            creates = '~/.undockerize/' + digest
+            stamp = ('mkdir -p "$HOME/.undockerize" && touch '
+                     '"$HOME/.undockerize/' + digest + '"')
+            if '\n' in cmd or '#' in cmd:  # can't just go after it
+                cmd = '(\n' + cmd.rstrip('\n') + '\n) && ' + stamp
+            else:
+                cmd += ' && ' + stamp
+            self.stats.count('stamps added')
+        else:
+            self.stats.count('creates inferred')
+        return Task(None, 'shell', {'cmd': cmd, 'creates': creates})
+
+    def creates_path(self, shell_cmd):
+        """
+        Returns the path that the last command of shell_cmd makes if it is
+        a download (curl -o, wget -O or wget of a url) or unzip -d, None if
+        it isn't (or the path has a var that isn't set, or is relative after
+        a cd of the chain)
+        """
+        if '\n' in shell_cmd:  # a script, lines aren't split on
+            return None
+        try:
+            lexer = shlex.shlex(shell_cmd, posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            tokens = list(lexer)
+        except ValueError:  # unbalanced quotes
+            return None
+        cmd = []
+        changes_dir = False  # a cd before the last command
+        for token in tokens:
+            if token in ('&&', '||', ';', '|', '&'):
+                changes_dir = changes_dir or cmd[:1] in (['cd'], ['pushd'])
+                cmd = []
+            else:
+                cmd.append(token)
+        # VAR=val before a command only matters for the command
+        while len(cmd) > 0 and re.match(r'[a-zA-Z_][a-zA-Z0-9_]*=', cmd[0]):
+            cmd = cmd[1:]
+        if len(cmd) < 2 or any(token[0] in '()<>' for token in cmd):
+            return None
+        path = None
+        options = {'curl': ('-o', '--output'),
+                   'wget': ('-O', '--output-document'),
+                   'unzip': ('-d',)}.get(cmd[0], ())
+        for x, arg in enumerate(cmd[1:-1], 1):
+            if arg in options:
+                path = cmd[x + 1]
+        if path is None and cmd[0] == 'wget' and len(cmd) == 2 and \
+                self.is_url(cmd[1]):  # saved in the work dir
+            path = cmd[1].split('?')[0].rstrip('/').split('/')[-1]
+        if path is None or path in ('', '-'):
+            return None
+        if self.is_relative_path(path):
+            if changes_dir:  # not relative to the work dir
+                return None
+            path = self.work_dir_path(path)
+        # ansible doesn't expand vars in creates (a stamp is used if one
+        # isn't set)
+        return self.expand_env_vars(path)
+
+    def stamp_digest(self, cmd):
+        """
+        Returns the hash of cmd and the values of the env vars it uses
+        (which names its stamp)
+        """
+        environment = sorted(self.env.used(cmd))
+        return hashlib.sha256(
+            (cmd + json.dumps(environment)).encode()).hexdigest()
+
+    def RUN_heredoc_helper(self, instruction):
+        """
+        Returns the script of a RUN that uses heredocs
+        RUN <<EOF runs the body as the script, otherwise the heredocs are
+        put back for the shell to handle (ex: RUN python3 <<EOF)
+        """
+        if heredoc_regex.sub('', instruction.args).strip() == '':
+            return ''.join(body for _, body in instruction.heredocs)
+        script = instruction.args + '\n'
+        for delimiter, body in instruction.heredocs:
+            script += body + delimiter + '\n'
+        return script
+
+    def referenced_files(self):
+        """
+        Returns the srcs of the COPYs and ADDs of every stage that come from
+        the dir of the Dockerfile (not urls, heredocs or other stages)
+        None if some of them can't be known (they use a variable)
+        """
+        preamble, stages = self.tokens
+        instructions = list(preamble)
+        for stage in stages:
+            instructions += stage.instructions
+        files = []
+        for instruction in instructions:
+            if instruction.command not in ('COPY', 'ADD'):
+                continue
+            flags, srcs, _ = self.copy_split(instruction.args)
+            if flags.get('from'):
+                continue
+            heredocs = dict(instruction.heredocs)
+            for src in srcs:
+                match = heredoc_regex.match(src)
+                if match is not None and match.group(3) in heredocs:
+                    continue
+                if self.is_url(src):
+                    continue
+                if '$' in src:
+                    return None
+                files.append(src.replace('\\ ', ' '))  # bracket form
+        return files
 
     def square_brackets_split(self, cmd):
         """
@@ -451,252 +1683,2230 @@ class Ansible:
     """
     Ansible Class
     ----------------------------------------
-    Holds the ansible info and writes the array to the yml file
+    Streams Tasks to a .yml (or .json) Ansible file (or stdout) through a
+    buffer as they are produced
     """
-    def __init__(self, ansible_array, env_vars):
+    def __init__(self, file_name, atomic=False, _format='yaml',
+                 buffer_size=65536, stats=None, record=False):
         """
-        Instantiates Ansible object
+        Instantiates Ansible object and opens the file
+        file_name '-' writes to (the real) stdout. When atomic the tasks go
+        to a temp file that replaces the real file once it's closed
+        When record the Tasks written are kept in tasks too
         """
-        self.ansible = ansible_array
-        self.env_vars = env_vars
-
-    def write_to_file(self, file_name):
+        self.json = _format == 'json'
+        self.stats = stats if stats is not None else Stats()
+        self.tasks = [] if record else None
+        # name -> content of the files the tasks need in the role
+        self.files = {}
+        # empty lines that haven't been written yet (dropped at the end)
+        self.pending_lines = 0
+        # no task has been written yet
+        self.first = True
+        self.atomic = False
+        if file_name == '-':
+            self.file_name = file_name
+            self.f = sys.__stdout__
+        else:
+            # remove .yml if it was included
+            if file_name[len(file_name)-4:] == '.yml':
+                file_name = file_name[:len(file_name)-4]
+            self.file_name = file_name + ('.json' if self.json else '.yml')
+
+            # Make dirs if not a path
+            final_dir = '/'.join(file_name.split('/')[:-1])
+            if final_dir != '':
+                os.makedirs(final_dir, exist_ok=True)
+
+            if atomic:
+                self.atomic = True
+                fd, self.tmp_name = tempfile.mkstemp(
+                    dir=final_dir or '.', prefix='.undockerize-',
+                    suffix='.tmp')
+                self.f = os.fdopen(fd, 'w', buffering=buffer_size)
+            else:
+                self.f = open(self.file_name, 'w', buffering=buffer_size)
+        self.write_line('[' if self.json else '---')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def append(self, task):
         """
-        Writes self.ansible to a .yml Ansible file
+        Writes a Task to the file
         """
-        # remove .yml if it was included
-        if file_name[len(file_name)-4:] == '.yml':
-            file_name = file_name[:len(file_name)-4]
-
-        # Make dirs if not a path
-        final_dir = '/'.join(file_name.split('/')[:-1])
-        if not os.path.isdir(final_dir) and final_dir != '':
-            os.makedirs(final_dir)
-
-        # write the ansible array to the file
-        with open(file_name + '.yml', 'w') as f:
-            for line in self.ansible:
-                f.write(line + '\n')
-
-
-"""------------------------------FROM STUFF--------------------------------"""
-
-
-def clean_workspace():
-    """
-    Deletes directories and files made by UnDockerized
-    """
-    if os.path.isfile('site.yml'):
-        os.remove('site.yml')
-    if os.path.isdir('roles'):
-        shutil.rmtree('roles')
-    if os.path.isdir(dependencies_dir):
-        shutil.rmtree(dependencies_dir)
+        if self.tasks is not None:
+            self.tasks.append(task)
+        self.files.update(task.files)
+        if self.stats.enabled:
+            start = time.perf_counter()
+            self.write_task(task)
+            self.stats.add_time('write', time.perf_counter() - start)
+            self.stats.count('tasks written')
+        else:
+            self.write_task(task)
 
+    def write_task(self, task):
+        """
+        Serializes a Task to the file
+        """
+        if self.json:
+            if task.module is None:  # JSON has no comments
+                return
+            if not self.first:
+                self.f.write(',\n')
+            self.f.write(json.dumps(task.to_dict(), ensure_ascii=False))
+        else:
+            for line in task.to_yaml():
+                self.write_line(line)
+            if task.module is not None:
+                self.write_line('')  # New line after command
+        self.first = False
 
-def dependencies_copy(repo, dir_str):
+    def write_line(self, line):
+        """
+        Writes a line to the file. Empty lines are held back until another
+        line comes so that the file doesn't end with them
+        """
+        if line == '':
+            self.pending_lines += 1
+            return
+        if self.pending_lines > 0:
+            self.f.write('\n' * self.pending_lines)
+            self.pending_lines = 0
+        self.f.write(line + '\n')
+
+    def close(self, success=True):
+        """
+        Flushes the file, moving it into place if it was written atomically
+        (or throwing it away if not success)
+        """
+        if self.json:
+            self.f.write('\n]\n')
+        if self.file_name == '-':
+            self.f.flush()
+            return
+        self.f.close()
+        if self.atomic:
+            if success:
+                # mkstemp makes it 0600, open() would have made it 0666
+                # minus the umask
+                os.chmod(self.tmp_name, 0o666 & ~umask)
+                os.replace(self.tmp_name, self.file_name)
+            else:
+                os.remove(self.tmp_name)
+
+
+class Cache:
     """
-    Copies the parent folder of the Dockerfile into
-    the Dependencies directory
+    Cache Class
+    ----------------------------------------
+    Keeps checkouts of the official-images and docker-library repos on disk
+    between runs so they only get fetched again once they are stale
     """
-    dependencies_repo_dir = dependencies_dir + repo + dir_str
-    print(dependencies_repo_dir)
-
-    if os.path.isdir(dependencies_repo_dir):  # Delete the old dir
-        shutil.rmtree(dependencies_repo_dir)
-
-    # Make copy of important dir for user
-    shutil.copytree(repo + dir_str, dependencies_repo_dir)
-    # Delete all subdirs of other versions from Dependencies dir
-    for root, subdirs, _ in os.walk(dependencies_repo_dir):
-        for subdir in subdirs:
-            shutil.rmtree(root + '/' + subdir)
-
+    # one lock per checkout so the same repo is never fetched twice at once
+    # (by any of the Caches of the process, other runs lock its lock file)
+    lock = threading.Lock()
+    path_locks = {}
 
-def get_repo_dir_from_docker_lib(repo, tags):
-    with open('official-images/library/'+repo, 'r') as f:
-        found = False
-        for line in f:
-            if line.startswith('Tags:'):
-                regex_ret = re.findall(r' '+tags+'[ \n,]', line)
-                if len(regex_ret) > 0:
-                    found = True
-            if found and line.startswith('Directory:'):
-                return re.findall(r'Directory: (.*)', line)[0]
+    def __init__(self, cache_dir, ttl, max_size, offline, sparse,
+                 stats=None):
+        """
+        Instantiates Cache object
+        ttl is in seconds, max_size in bytes
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.repos_dir = os.path.join(self.cache_dir, 'repos')
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        # only fetch the dirs that are asked for
+        self.sparse = sparse
+        self.stats = stats if stats is not None else Stats()
+        # checkouts that are already up to date for this run
+        self.updated = set()
+
+    def fetch(self, link, directory=None):
+        """
+        Returns the path of a checkout of link, cloning or updating it if
+        it is missing or stale. Returns None if link is not a repo (or it
+        can't be fetched and isn't cached)
+        When sparse, only the files directly in directory get checked out
+        Safe to call from several threads (and runs sharing the cache)
+        """
+        sparse = self.sparse and directory is not None
+        path = self.key_path(link + '#sparse' if sparse else link)
+        with self.path_lock(path), self.stats.timer('fetch'):
+            if sparse:
+                return self.fetch_sparse(link, directory.strip('/'))
+            return self.fetch_full(link)
+
+    @contextlib.contextmanager
+    def path_lock(self, path):
+        """
+        Holds the lock of the checkout at path in the with block, against
+        the other threads and the other runs that use the cache (which
+        lock path.lock, where there is flock)
+        """
+        with Cache.lock:
+            path_lock = Cache.path_locks.setdefault(path, threading.Lock())
+        with path_lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.repos_dir, exist_ok=True)
+            with open(path + '.lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def clone(self, link, path, git_args, setup_args=()):
+        """
+        Clones link with the git_args of clone (then runs the git commands
+        of setup_args in it) in a temp dir that is moved to path once it's
+        done, so a clone that was cut off is never used
+        Returns true if path has a clone (maybe from another run)
+        """
+        tmp_dir = tempfile.mkdtemp(dir=self.repos_dir, prefix='.clone-')
+        ret = self.git(['clone', '-q'] + git_args + [link, tmp_dir])
+        for args in setup_args:
+            if ret == 0:
+                ret = self.git(['-C', tmp_dir] + args)
+        if ret == 0:
+            try:
+                os.rename(tmp_dir, path)
+            except OSError:  # another run moved its clone there first
+                ret = 0 if os.path.isdir(path) else 1
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        return ret == 0
+
+    def fetch_full(self, link):
+        """
+        Fetch for a complete clone of link
+        """
+        path = self.key_path(link)
+        os.makedirs(self.repos_dir, exist_ok=True)
+
+        if os.path.isdir(path):
+            if self.is_stale(path):
+                start = time.time()
+                self.update(link, path, ['pull', '-q'], start)
+            self.touch(path + '.used')
+            return path
+
+        if self.offline:
+            return None
+        start = time.time()
+        if not self.clone(link, path, []):
+            return None
+        self.print_fetch_time('Cloned', link, start)
+        self.updated.add(path)
+        self.touch(path + '.fetched')
+        self.touch(path + '.used')
+        return path
+
+    def fetch_sparse(self, link, directory):
+        """
+        Fetch for a shallow clone of link that only checks out the files of
+        the dirs that have been asked for (blobs of everything else are
+        never downloaded if the server supports filters)
+        """
+        path = self.key_path(link + '#sparse')
+        os.makedirs(self.repos_dir, exist_ok=True)
+        # Files directly in directory, but none of its subdirs
+        patterns = ['/' + directory + '/*', '!/' + directory + '/*/']
+        if directory in ('', '.'):
+            patterns = ['/*', '!/*/']
+
+        if os.path.isdir(path):
+            start = time.time()
+            if self.is_stale(path):
+                self.update(link, path, ['fetch', '-q', '--depth', '1',
+                                         'origin'], start)
+                self.git(['-C', path, 'reset', '-q', '--hard',
+                          'FETCH_HEAD'])
+            with open(path + '/.git/info/sparse-checkout', 'r') as f:
+                checked_out = f.read().split('\n')
+            if patterns[0] not in checked_out:
+                self.git(['-C', path, 'sparse-checkout', 'add'] + patterns)
+            self.touch(path + '.used')
+            return path
+
+        if self.offline:
+            return None
+        start = time.time()
+        if not self.clone(link, path,
+                          ['--depth', '1', '--filter=blob:none',
+                           '--no-checkout'],
+                          [['sparse-checkout', 'set', '--no-cone'] + patterns,
+                           ['checkout', '-q']]):
+            return None
+        self.print_fetch_time('Cloned', link, start)
+        self.updated.add(path)
+        self.touch(path + '.fetched')
+        self.touch(path + '.used')
+        return path
+
+    def evict(self):
+        """
+        Deletes the least recently used checkouts until the cache fits in
+        max_size
+        """
+        if not os.path.isdir(self.repos_dir):
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.repos_dir):
+            path = os.path.join(self.repos_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue  # clones that are being made
+            size = dir_size(path)
+            used = self.mtime(path + '.used')
+            entries.append((used, size, path))
+            total += size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            with self.path_lock(path):  # not while another run uses it
+                shutil.rmtree(path, ignore_errors=True)
+            for ext in ('.fetched', '.used'):
+                if os.path.isfile(path + ext):
+                    os.remove(path + ext)
+            total -= size
+
+    def is_stale(self, path):
+        """
+        Returns true if path needs to be updated before it is used
+        """
+        return (not self.offline and path not in self.updated and
+                not self.is_fresh(path + '.fetched'))
+
+    def update(self, link, path, git_args, start):
+        """
+        Runs the git command that updates a stale checkout
+        """
+        self.updated.add(path)
+        if self.git(['-C', path] + git_args) == 0:
+            self.touch(path + '.fetched')
+            self.print_fetch_time('Updated', link, start)
+        else:
+            logger.warning('Could not update ' + link + ', using cached copy')
+
+    def git(self, git_args):
+        """
+        Runs git quietly without ever prompting for credentials
+        Returns the exit code
+        """
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        sub_cmd = git_args[2] if git_args[0] == '-C' else git_args[0]
+        with self.stats.timer('git ' + sub_cmd):
+            return subprocess_call(['git'] + git_args, stdout=PIPE,
+                                   stderr=PIPE, env=env)
+
+    def print_fetch_time(self, action, link, start):
+        """
+        Reports how long fetching link took
+        """
+        self.stats.count('repos ' + action.lower())
+        logger.info(action + ' ' + link + ' in ' +
+                    '%.2f' % (time.time() - start) + 's')
+
+    def is_fresh(self, stamp):
+        """
+        Returns true if stamp was touched less than ttl seconds ago
+        """
+        return time.time() - self.mtime(stamp) < self.ttl
+
+    def key_path(self, link):
+        """
+        Returns where the checkout of link lives (named by the hash of link)
+        """
+        key = hashlib.sha1(link.encode('utf-8')).hexdigest()
+        return os.path.join(self.repos_dir, key)
+
+    def mtime(self, stamp):
+        """
+        Returns the modification time of stamp, 0 if it doesn't exist
+        """
+        try:
+            return os.path.getmtime(stamp)
+        except OSError:
+            return 0
+
+    def touch(self, stamp):
+        """
+        Creates stamp or updates its modification time
+        """
+        with open(stamp, 'a'):
+            os.utime(stamp, None)
 
 
-def get_repos_with_FROM(FROM):
+class TaskCache:
     """
-    Recursively go up the chain of turtles until an os image is found (no repo)
+    TaskCache Class
+    ----------------------------------------
+    Keeps the tasks that Dockerfiles (base images mostly) were converted to
+    on disk, so a Dockerfile that is converted again with the same options
+    (by any run) gets them back instead of being parsed again
     """
-    stripped_FROM = ''.join(FROM.split()[1:])
-    split_FROM = stripped_FROM.split(':')
+    def __init__(self, cache_dir, max_size, options, stats=None):
+        """
+        Instantiates TaskCache object
+        max_size is in bytes, options are the ones that change the tasks
+        """
+        self.tasks_dir = os.path.join(os.path.expanduser(cache_dir),
+                                      'tasks')
+        self.max_size = max_size
+        self.header = [__version__, Manifest.generator(), options]
+        self.stats = stats if stats is not None else Stats()
 
-    repo = split_FROM[0]
-    tags = split_FROM[1]
-    dirs = tags.split('-')
-    # Make a string to find the correct directory
-    dir_str = ''
-    version = ''
-    for _dir in dirs:
-        version += '_' + _dir
-        dir_str += '/' + _dir
+    def key(self, docker):
+        """
+        Returns the key of the tasks of a Docker object: the hash of its
+        Dockerfile (and dir), stage, role and the paths of its context if
+        it copies anything from it, along with the version and options
+        """
+        context = None
+        if any(instruction.command in ('COPY', 'ADD')
+               for instruction in docker.instructions):
+            context = docker.context.fingerprint(docker.referenced_files())
+        key = json.dumps(self.header + [docker.digest, docker.stage,
+                                        docker.role, context],
+                         sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the Tasks saved under key, None if there aren't any
+        """
+        path = os.path.join(self.tasks_dir, key + '.json')
+        try:
+            with open(path, 'r') as f:
+                records = json.load(f)
+            os.utime(path, None)  # used, so it's evicted last
+        except (OSError, ValueError):
+            self.stats.count('task cache misses')
+            return None
+        self.stats.count('task cache hits')
+        return [Task.from_record(record) for record in records]
+
+    def put(self, key, tasks):
+        """
+        Saves tasks under key (through a temp file, since other runs might
+        be reading it)
+        """
+        os.makedirs(self.tasks_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.tasks_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump([task.to_record() for task in tasks], f)
+        os.replace(tmp_name, os.path.join(self.tasks_dir, key + '.json'))
 
-    # Check if dir exists
-    link = 'https://github.com/docker-library/' + repo + '.git'
-    try:
-        urllib.request.urlopen(link)
-    except:
-        print('Docker used image:\n        ' + stripped_FROM)
-        return
+    def evict(self):
+        """
+        Deletes the least recently used tasks until they fit in max_size
+        """
+        if not os.path.isdir(self.tasks_dir):
+            return
+        entries = []
+        total = 0
+        for entry in os.scandir(self.tasks_dir):
+            try:
+                stat = entry.stat()
+            except OSError:  # evicted by another run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class LibraryIndex:
+    """
+    LibraryIndex Class
+    ----------------------------------------
+    Parses every file of the official-images library once so that the
+    GitCommit/Directory/Architectures of a repo's tag can be looked up
+    without reading the library again
+    """
+    # Keys of a library entry that are kept (in this order)
+    fields = ('GitCommit', 'Directory', 'Architectures')
 
-    # Keep cloning repos until it finds on that is an image
-    # Must be an image if there is no repo there
-    repos.append(repo)
-    repo_versions.append(version)
+    def __init__(self, repos):
+        """
+        Instantiates LibraryIndex object
+        repos is {repo: {'tags': {tag: entry number}, 'entries': [entry]}}
+        where each entry is a list of the values of fields
+        """
+        self.repos = repos
 
-    # clone the repo
-    subprocess_call(['git', 'clone', link], stdout=PIPE, stderr=PIPE)
+    @classmethod
+    def load(cls, library_dir, index_dir):
+        """
+        Returns the index of the library in library_dir (an official-images
+        checkout). The index gets saved in index_dir under the commit of the
+        checkout, so it's only built again when the library changes (or
+        the saved one can't be read)
+        """
+        commit = cls.commit(library_dir)
+        index_file = os.path.join(index_dir, commit + '.json')
+        if commit != '':
+            try:
+                with open(index_file, 'r') as f:
+                    return cls(json.load(f))
+            except (OSError, ValueError):  # not saved yet (or cut off)
+                pass
+
+        index = cls.build(os.path.join(library_dir, 'library'))
+        if commit != '':
+            os.makedirs(index_dir, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index.repos, f, separators=(',', ':'))
+            os.replace(tmp_name, index_file)
+            cls.remove_old(index_dir, index_file)
+        return index
+
+    @staticmethod
+    def remove_old(index_dir, index_file):
+        """
+        Deletes the indexes (and temp files) in index_dir but index_file
+        that are more than a day old, so that a run still using one of the
+        last commit's doesn't lose it
+        """
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            try:
+                if (path != index_file and
+                        time.time() - os.path.getmtime(path) > 86400):
+                    os.remove(path)
+            except OSError:  # removed by another run
+                pass
+
+    @staticmethod
+    def commit(library_dir):
+        """
+        Returns the commit of the official-images checkout in library_dir
+        ('' if it isn't a git checkout)
+        """
+        return subprocess_run(
+            ['git', '-C', library_dir, 'rev-parse', 'HEAD'],
+            stdout=PIPE, stderr=PIPE, universal_newlines=True).stdout.strip()
 
-    dir_str = '/' + get_repo_dir_from_docker_lib(repo, tags)
-    dependencies_copy(repo, dir_str)
+    @classmethod
+    def build(cls, library_dir):
+        """
+        Returns the index of every file in library_dir
+        """
+        repos = {}
+        for repo in sorted(os.listdir(library_dir)):
+            with open(os.path.join(library_dir, repo), 'r') as f:
+                repos[repo] = cls.parse_library_file(f)
+        return cls(repos)
+
+    @classmethod
+    def parse_library_file(cls, f):
+        """
+        Parses one library file: RFC 2822 style paragraphs split by empty
+        lines, where the first paragraph holds the defaults of the others
+        Returns {'tags': {tag: entry number}, 'entries': [entry]}
+        """
+        tags = {}
+        entries = []
+        defaults = {'Directory': '.', 'Architectures': 'amd64'}
+        paragraph = {}
+        key = None
+        for line in list(f) + ['']:
+            line = line.rstrip()
+            if line.startswith('#'):
+                continue
+            if line == '':  # end of a paragraph
+                if 'Tags' not in paragraph and 'SharedTags' not in paragraph:
+                    defaults.update(paragraph)
+                elif len(paragraph) > 0:
+                    entry = dict(defaults, **paragraph)
+                    entries.append([entry.get(field, '')
+                                    for field in cls.fields])
+                    all_tags = (entry.get('Tags', '') + ',' +
+                                entry.get('SharedTags', ''))
+                    for tag in all_tags.split(','):
+                        tag = tag.strip()
+                        # first entry with a tag wins
+                        if tag != '' and tag not in tags:
+                            tags[tag] = len(entries) - 1
+                paragraph = {}
+                key = None
+            elif line[0].isspace() and key is not None:  # continued value
+                paragraph[key] += ' ' + line.strip()
+            elif ':' in line:
+                key, val = line.split(':', 1)
+                paragraph[key] = val.strip()
+        return {'tags': tags, 'entries': entries}
+
+    def lookup(self, repo, tag):
+        """
+        Returns {field: value} for the tag of repo, None if there is no
+        such repo or tag
+        """
+        library = self.repos.get(repo)
+        if library is None or tag not in library['tags']:
+            return None
+        entry = library['entries'][library['tags'][tag]]
+        return dict(zip(self.fields, entry))
 
-    # instantiate a new Docker object
-    docker_file = repo + dir_str + '/Dockerfile'
-    docker_files.append(Docker(docker_file, dir_str))
 
-    # recursively call on next FROM statement
-    get_repos_with_FROM(docker_files[-1].FROM)
+# a COPY or ADD instruction in a Dockerfile
+copy_regex = re.compile(rb'^[ \t]*(?:COPY|ADD)[ \t]',
+                        re.IGNORECASE | re.MULTILINE)
 
 
-def make_ansible_config_file():
+class Manifest:
     """
-    Makes a config file to make sure long commands don't time out the ssh
-    connection
+    Manifest Class
+    ----------------------------------------
+    Remembers what each role was generated from (a hash of its Dockerfile,
+    the images and stages it needs and its chain) and which role each
+    image resolved to, so that a later run can leave the roles that didn't
+    change alone
     """
-    with open('ansible.cfg', 'w') as f:
-        f.write('[defaults]\n')
-        f.write('host_key_checking = False\n\n')
-        f.write('[ssh_connection]\n')
-        f.write(
-            'ssh_args = -o ServerAliveInterval=30 -o ServerAliveCountMax=30')
+    def __init__(self, file_name, options, ttl, offline=False):
+        """
+        Instantiates Manifest object and loads the last run's manifest
+        Everything in it is forgotten if it was made by another version or
+        with other options, since all of the roles would come out different
+        The roles are in the dir of file_name
+        """
+        self.file_name = file_name
+        self.output_dir = os.path.dirname(file_name) or '.'
+        self.header = {'version': __version__, 'generator': self.generator(),
+                       'options': options}
+        # how long a resolved image is trusted before resolving it again
+        # (forever when offline)
+        self.ttl = ttl
+        self.offline = offline
+        # role -> {'hash', 'needs': [images, stage roles], 'chain'}
+        self.roles = {}
+        # image -> {'role' (None for an os image), 'resolved'}
+        self.images = {}
+        try:
+            with open(file_name, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if all(manifest.get(key) == val for key, val in self.header.items()):
+            self.roles = manifest.get('roles', {})
+            self.images = manifest.get('images', {})
+
+    @staticmethod
+    @functools.lru_cache(1)
+    def generator():
+        """
+        Returns the hash of this file, so that the roles made by a changed
+        undockerize (even without a new version) are made again
+        Only read once per process
+        """
+        with open(__file__, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def digest(content, dir_str, context=None, srcs=None):
+        """
+        Returns the hash of the content of a Dockerfile (and the dir its
+        dependencies are in, which ends up in the tasks). If it has a COPY
+        or ADD, the paths of its BuildContext that they use go in too, since
+        the globs of the tasks come from them (srcs are what
+        Docker.referenced_files returns, every path if they aren't known)
+        """
+        sha = hashlib.sha256(dir_str.encode() + b'\0')
+        sha.update(content)
+        if context is not None and copy_regex.search(content):
+            sha.update(b'\0' + context.fingerprint(srcs).encode())
+        return sha.hexdigest()
+
+    def needs(self, role, digest=None):
+        """
+        Returns {role: [images, stage roles] it needs} of role and the stage
+        roles it needs if all of their tasks files are up to date (with the
+        Dockerfile that hashes to digest, if one is given), otherwise None
+        """
+        needs = {}
+        roles = [role]
+        while len(roles) > 0:
+            role = roles.pop()
+            record = self.roles.get(role)
+            if record is None or digest not in (None, record['hash']):
+                return None
+            tasks_file = tasks_file_name(
+                role, self.header['options']['format'], self.output_dir)
+            if not os.path.isfile(tasks_file):
+                return None
+            needs[role] = record['needs']
+            roles += record['needs'][1]
+        return needs
+
+    def image(self, image):
+        """
+        Returns (role or None for an os image, {role: needs} like needs())
+        of what image resolved to last time if that can be used without
+        resolving it again, otherwise None
+        """
+        record = self.images.get(image)
+        if record is None:
+            return None
+        if not self.offline and time.time() - record['resolved'] > self.ttl:
+            return None
+        if record['role'] is None:
+            return None, {}
+        needs = self.needs(record['role'])
+        if needs is None:
+            return None
+        return record['role'], needs
+
+    def record_role(self, role, digest, needs):
+        """
+        Remembers the Dockerfile role was generated from and what it needs
+        """
+        self.roles[role] = {'hash': digest, 'needs': needs,
+                            'chain': self.roles.get(role, {}).get('chain')}
+
+    def record_image(self, image, role):
+        """
+        Remembers which role image resolved to
+        """
+        self.images[image] = {'role': role, 'resolved': time.time()}
+
+    def forget(self, role):
+        """
+        Drops the record of role (its tasks went somewhere else)
+        """
+        self.roles.pop(role, None)
+
+    def save(self, chains):
+        """
+        Saves the manifest, with chains being {role: FROM chain of the role}
+        """
+        for role, chain in chains.items():
+            if role in self.roles:
+                self.roles[role]['chain'] = chain
+        manifest = dict(self.header, roles=self.roles, images=self.images)
+        write_file(self.file_name,
+                   json.dumps(manifest, indent=1, sort_keys=True) + '\n')
+
+
+class Stats:
+    """
+    Stats Class
+    ----------------------------------------
+    Timers and counters of where a run spends its time. Safe to use from
+    several threads, and does nothing unless it's enabled
+    """
+    def __init__(self, enabled=False):
+        """
+        Instantiates Stats object
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # name -> [times, seconds]
+        self.timers = {}
+        # name -> count
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    def __getstate__(self):
+        """
+        Returns what gets pickled: a copy in another process starts from
+        zero (and its report gets merged back)
+        """
+        return {'enabled': self.enabled}
+
+    def __setstate__(self, state):
+        """
+        Unpickles an empty Stats
+        """
+        self.__init__(state['enabled'])
+
+    def merge(self, report):
+        """
+        Adds the timers and counters of a report (of another process)
+        """
+        with self.lock:
+            for name, timer in report['timers'].items():
+                total = self.timers.setdefault(name, [0, 0.0])
+                total[0] += timer['count']
+                total[1] += timer['seconds']
+            for name, count in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + count
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Times the with block under name
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """
+        Adds one time to the timer name
+        """
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def count(self, name, n=1):
+        """
+        Adds n to the counter name
+        """
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        Returns the timers and counters as a dict (for the JSON report)
+        """
+        with self.lock:
+            return {
+                'seconds': time.perf_counter() - self.start,
+                'timers': {name: {'count': count, 'seconds': seconds}
+                           for name, (count, seconds) in self.timers.items()},
+                'counters': dict(self.counters)}
+
+    def summary(self):
+        """
+        Returns the lines of a summary of the timers (slowest first) and
+        counters. Timers can contain each other (handle RUN includes its
+        write) and the ones from several threads can add up to more than
+        the whole run
+        """
+        report = self.report()
+        lines = ['Stats (%.3fs):' % report['seconds']]
+        timers = sorted(report['timers'].items(),
+                        key=lambda timer: -timer[1]['seconds'])
+        for name, timer in timers:
+            lines.append('  %-24s %6d x %9.3fs' % (
+                name, timer['count'], timer['seconds']))
+        for name, count in sorted(report['counters'].items()):
+            lines.append('  %-24s %6d' % (name, count))
+        return lines
+
+
+class LRU:
+    """
+    LRU Class
+    ----------------------------------------
+    Dict that only keeps the max_size most recently used items (and, with
+    a ttl, only for ttl seconds), counting its hits and misses. Safe to use
+    from several threads
+    """
+    def __init__(self, max_size, ttl=None):
+        """
+        Instantiates LRU object
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (value, time it was put), least recently used first
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the value of key, None if it isn't there (or is too old)
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and (self.ttl is None or
+                                     time.time() - item[1] < self.ttl):
+                self.items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Puts key in, dropping the least recently used items that don't fit
+        """
+        with self.lock:
+            self.items[key] = (value, time.time())
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def metrics(self):
+        """
+        Returns the size, hits, misses and evictions as a dict
+        """
+        with self.lock:
+            return {'size': len(self.items), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
 
 
-def make_ansible_role_file(tasks):
+class Memory:
     """
-    Creates a role file (site.yml) given all of the tasks
+    Memory Class
+    ----------------------------------------
+    What a long running undockerize (serve) keeps in memory between
+    conversions: the library indexes (by official-images commit), where
+    each image resolved to, and the tokens of every Dockerfile (by the
+    hash of its content)
+    """
+    def __init__(self, max_size, ttl):
+        """
+        Instantiates Memory object
+        Each of the LRUs keeps max_size items, and the resolved images are
+        resolved again after ttl seconds (like the cached repos are updated)
+        """
+        self.library = LRU(max_size)
+        self.images = LRU(max_size, ttl)
+        self.dockerfiles = LRU(max_size)
+
+    def metrics(self):
+        """
+        Returns the metrics of each LRU
+        """
+        return {'library': self.library.metrics(),
+                'images': self.images.metrics(),
+                'dockerfiles': self.dockerfiles.metrics()}
+
+
+"""------------------------------FROM STUFF--------------------------------"""
+
+
+class UndockerizeError(Exception):
+    """
+    UndockerizeError Class
+    ----------------------------------------
+    Raised when a conversion can't go on (the message says why)
+    """
+
+
+class Conversion:
     """
-    with open('site.yml', 'w') as f:
-        f.write('---\n')
-        f.write('- hosts: all\n')
-        f.write('  become: yes\n')
-        f.write('  roles:\n')
+    Conversion Class
+    ----------------------------------------
+    One run of undockerize: its options and everything it finds out while
+    following the FROM chains. Nothing is shared between Conversions (but
+    the cache on disk, and the Memory if one is given), so several can run
+    at once in one process
+    """
+    def __init__(self, options, memory=None):
+        """
+        Instantiates Conversion object
+        options are {long option name: value}, like default_options()
+        memory is a Memory shared with other conversions (undockerize serve)
+        """
+        self.input_file = options['input_file']
+        self.output_role = options['output_role']
+        # where the roles, site files and UnDock_Dependencies go
+        self.output_dir = options['output_dir']
+        self.clean = options['clean']
+        self.nobuild = options['nobuild']
+        self.batch = options['batch']
+        self.stdout = options['stdout'] and self.batch is None
+        self.atomic = options['atomic']
+        self._format = options['format']
+        self.coalesce_runs = options['coalesce_runs']
+        self.native_packages = options['native_packages']
+        self.staging = options['staging']
+        self.synchronize = options['synchronize']
+        self.script_threshold = options['script_threshold']
+        self.idempotent = options['idempotent']
+        self.env_file = options['env_file']
+        self.jobs = max(1, options['jobs'])
+        self.parse_jobs = max(1, options['parse_jobs'])
+        self.max_depth = options['max_depth']
+        self.provided = options['provided']
+        self.git_base = options['git_base']
+        if not self.git_base.endswith('/'):
+            self.git_base += '/'
+        self.stats = Stats(options['stats'] or
+                           options['stats_json'] is not None)
+        self.cache = Cache(options['cache_dir'], options['cache_ttl'],
+                           options['cache_size'] * 1024 * 1024,
+                           options['offline'], options['fetch'] == 'sparse',
+                           self.stats)
+        self.cache_ttl = options['cache_ttl']
+        # Tasks of the Dockerfiles converted before (unless --no-cache)
+        self.task_cache = None
+        if not options['no_cache']:
+            self.task_cache = TaskCache(
+                options['cache_dir'],
+                options['tasks_cache_size'] * 1024 * 1024,
+                {'coalesce_runs': self.coalesce_runs,
+                 'native_packages': self.native_packages,
+                 'synchronize': self.synchronize,
+                 'script_threshold': self.script_threshold,
+                 'idempotent': self.idempotent,
+                 'env_file': self.env_file}, self.stats)
+        self.memory = memory
+
+        # where the files of the images are staged (from the playbooks)
+        self.dependencies_name = 'UnDock_Dependencies/'
+        self.dependencies_dir = self.path(self.dependencies_name)
+        self.manifest_file = self.path('.undockerize.json')
+        self.manifest = None
+        self.load_manifest()
+
+        self.docker_files = {}  # Role names -> Docker objects that are created
+        self.role_needs = {}  # Role names -> [images, stage roles] they need
+        self.FROM_roles = {}  # Images -> (Futures of) their role names
+        self.stopped_images = {}  # Images the chains stopped at -> why
+        self.FROM_lock = threading.Lock()  # Guards FROM_roles, stopped_images
+        self.contexts = {}  # Dirs -> their BuildContexts (scanned once)
+        self.contexts_lock = threading.Lock()
+        # LibraryIndex of official-images once it's needed
+        self.library_index = None
+        self.library_lock = threading.Lock()  # Guards library_index
+
+        # What run made: every role (in the order they were written), the
+        # tasks files that were written and the site files
+        self.roles = []
+        self.tasks_files = {}
+        self.site_files = []
+
+    def run(self, services=None):
+        """
+        Converts the Dockerfile(s) and writes the roles and site file(s)
+        services are (Dockerfile, role name, dependencies dir[, build
+        context dir if the files aren't in the dependencies dir]), by
+        default the ones of -i and -o (or -b)
+        Returns the Conversion
+        """
+        if self.clean:
+            self.clean_workspace()
+        if self.nobuild:
+            return self
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # Parse input Dockerfile(s)
+        if services is None and self.batch is None:
+            services = [(self.input_file, self.output_role, '.')]
+        elif services is None:
+            services = get_batch_services(self.batch)
+        roles = self.roles
+        for file_name, role, dir_str, *context_dir in services:
+            if not os.path.isfile(file_name):
+                raise UndockerizeError('File "' + file_name +
+                                       '" does not exist')
+            if role in roles:
+                raise UndockerizeError('Role "' + role + '" is used twice')
+            roles.append(role)
+            self.load_docker(file_name, dir_str, role, *context_dir)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool, \
+                self.stats.timer('resolve'):
+            # Recursively get all the repos from FROM statements (and the
+            # stages that the last stages need)
+            chains = list(pool.map(self.get_role_chain, roles))
+
+        # Tell what the chains were cut off at (which has to be on the hosts)
+        for image in sorted(self.stopped_images):
+            logger.info('Stopped at image (' + self.stopped_images[image] +
+                        '):\n        ' + image)
+
+        site_files = []
+        for (_, role, *_), chain in zip(services, chains):
+            # stages can need the same role (ex: both FROM one image)
+            for repo_task in chain:
+                if repo_task not in roles:
+                    roles.append(repo_task)
+            # Want roles above this line to run in reverse order (each one
+            # after everything it needs)
+            repo_tasks = []
+            for repo_task in reversed([role] + chain):
+                if repo_task not in repo_tasks:
+                    repo_tasks.append(repo_task)
+            if self.batch is None:
+                site_files.append(('site.yml', repo_tasks))
+            else:
+                site_files.append(('site_' + role + '.yml', repo_tasks))
+
+        # Write all of the ansible files (once per role, in the same order
+        # whichever thread made them)
+        # (roles without a Docker object are up to date)
+        runs = 0
+        runs_removed = 0
+        jobs = []  # (role, Docker object, tasks file name)
+        for role in roles:
+            docker_file = self.docker_files.get(role)
+            if docker_file is None:
+                self.stats.count('roles up to date')
+                continue
+            self.stats.count('roles written')
+            if self.coalesce_runs:
+                runs += len([instruction for instruction in
+                             docker_file.instructions
+                             if instruction.command == 'RUN'])
+                runs_removed += docker_file.coalesce_runs()
+            file_name = self.path('roles/' + role + '/tasks/main')
+            if self.stdout and role == self.output_role:
+                file_name = '-'
+                self.manifest.forget(role)
+            else:
+                self.manifest.record_role(role, docker_file.digest,
+                                          self.role_needs[role])
+            jobs.append((role, docker_file, file_name))
+        self.write_roles(jobs)
+
+        if self.coalesce_runs:
+            logger.info('Coalesced ' + str(runs) + ' RUN instructions into ' +
+                        str(runs - runs_removed) + ' tasks (' +
+                        str(runs_removed) + ' fewer ssh round trips)')
+
+        # Make the site file(s)
+        for file_name, repo_tasks in site_files:
+            self.make_ansible_role_file(repo_tasks, file_name)
+            self.site_files.append(self.path(file_name))
+
+        # Generates the ansible.cfg file for ssh timeout
+        self.make_ansible_config_file()
+
+        # Remember what everything was generated from for the next run
+        self.manifest.save({role: chain
+                            for (_, role, *_), chain in zip(services, chains)})
+
+        # Keep the cache from growing forever
+        self.cache.evict()
+        if self.task_cache is not None:
+            self.task_cache.evict()
+
+        # print ansible command to run the generated code
+        for file_name, _ in site_files:
+            logger.info('ansible-playbook ' + file_name +
+                        ' -u <user> -i <host>,')
+        return self
+
+    def write_roles(self, jobs):
+        """
+        Converts the Docker objects of jobs (role, Docker object, tasks file
+        name) to their tasks files. Each one is streamed to its file by one
+        of --jobs threads, or of --parse-jobs processes, while the others
+        are converted. Every file comes out the same either way
+        """
+        args = [(docker, file_name, self.path('roles/' + role),
+                 self._format, self.atomic, self.task_cache)
+                for role, docker, file_name in jobs]
+        with self.stats.timer('convert'):
+            # the tasks of a process can't go to the stdout of this one
+            if self.parse_jobs > 1 and len(jobs) > 1 and not self.stdout:
+                with ProcessPoolExecutor(
+                        min(self.parse_jobs, len(jobs))) as pool:
+                    written = [pool.submit(write_tasks, *arg)
+                               for arg in args]
+                    for (role, _, _), future in zip(jobs, written):
+                        file_name, report = future.result()
+                        self.stats.merge(report)  # made in another process
+                        self.tasks_files[role] = file_name
+            else:
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    written = [pool.submit(write_tasks, *arg)
+                               for arg in args]
+                    for (role, _, _), future in zip(jobs, written):
+                        self.tasks_files[role] = future.result()[0]
+
+    def path(self, file_name):
+        """
+        Returns where file_name goes in the output dir
+        """
+        if self.output_dir == '.':
+            return file_name
+        return os.path.join(self.output_dir, file_name)
+
+    def load_manifest(self):
+        """
+        Loads the manifest of the last run in the output dir
+        """
+        # Options that change what the tasks come out as
+        self.manifest = Manifest(
+            self.manifest_file,
+            {'format': self._format, 'coalesce_runs': self.coalesce_runs,
+             'native_packages': self.native_packages,
+             'synchronize': self.synchronize,
+             'script_threshold': self.script_threshold,
+             'idempotent': self.idempotent, 'env_file': self.env_file,
+             'git_base': self.git_base},
+            self.cache_ttl, self.cache.offline)
+
+    def clean_workspace(self):
+        """
+        Deletes directories and files made by UnDockerized
+        """
+        if os.path.isfile(self.path('site.yml')):
+            os.remove(self.path('site.yml'))
+        if os.path.isdir(self.output_dir):
+            for _file in os.listdir(self.output_dir):  # batch site files
+                if _file.startswith('site_') and _file.endswith('.yml'):
+                    os.remove(self.path(_file))
+        if os.path.isdir(self.path('roles')):
+            shutil.rmtree(self.path('roles'))
+        if os.path.isdir(self.dependencies_dir):
+            shutil.rmtree(self.dependencies_dir)
+        if os.path.isfile(self.manifest_file):
+            os.remove(self.manifest_file)
+        self.load_manifest()
+
+    def dependencies_copy(self, repo, repo_dir, dir_str, docker=None):
+        """
+        Copies the parent folder of the Dockerfile into
+        the Dependencies directory
+        With --staging link only the files its COPYs and ADDs use (and the
+        Dockerfile) are staged, as links to the cache where they can be.
+        docker is the Docker object of the Dockerfile if it was made
+        """
+        dependencies_repo_dir = self.dependencies_dir + repo + dir_str
+        logger.info(dependencies_repo_dir)
+
+        # Only the files of the dir are copied, the subdirs are other
+        # versions (which might be getting copied by another thread now)
+        if os.path.isdir(dependencies_repo_dir):  # Delete the old files
+            for entry in os.scandir(dependencies_repo_dir):
+                if not entry.is_dir(follow_symlinks=False):
+                    os.remove(entry.path)
+        else:
+            os.makedirs(dependencies_repo_dir, exist_ok=True)
+
+        # Make copy of important files for user
+        with self.stats.timer('copy'):
+            entries = [entry for entry in os.scandir(repo_dir + dir_str)
+                       if entry.is_file()]
+            if self.staging == 'link':
+                if docker is None:
+                    docker = self.make_docker(
+                        repo_dir + dir_str + '/Dockerfile', dir_str)
+                names = staged_names(docker.referenced_files(),
+                                     [entry.name for entry in entries])
+                for entry in entries:
+                    if entry.name in names:
+                        how = link_file(entry.path, os.path.join(
+                            dependencies_repo_dir, entry.name))
+                        self.stats.count('files ' + how)
+                        if how == 'copied':
+                            self.stats.count('bytes copied',
+                                             entry.stat().st_size)
+                return
+            for entry in entries:
+                shutil.copy2(entry.path, dependencies_repo_dir)
+                self.stats.count('files copied')
+                self.stats.count('bytes copied', entry.stat().st_size)
+
+    def get_library_index(self):
+        """
+        Returns the LibraryIndex of the official-images library, which only
+        gets fetched the first time it's needed (not at all if every FROM
+        chain is already in the manifest)
+        Raises UndockerizeError if it couldn't be fetched
+        """
+        with self.library_lock:
+            if self.library_index is None:
+                library_dir = self.cache.fetch(
+                    self.git_base + 'official-images.git', 'library')
+                if library_dir is None:
+                    raise UndockerizeError(
+                        'Could not get the official-images library')
+                if self.memory is not None:
+                    commit = LibraryIndex.commit(library_dir)
+                    self.library_index = self.memory.library.get(commit)
+                if self.library_index is None:
+                    with self.stats.timer('library index'):
+                        self.library_index = LibraryIndex.load(
+                            library_dir,
+                            os.path.join(self.cache.cache_dir, 'library'))
+                    if self.memory is not None and commit != '':
+                        self.memory.library.put(commit, self.library_index)
+        return self.library_index
+
+    def get_repo_dir_from_docker_lib(self, repo, tags):
+        """
+        Returns the Directory of the tags in the library file of repo
+        None if the library has no such repo or tags
+        """
+        entry = self.get_library_index().lookup(repo, tags)
+        if entry is None:
+            return None
+        return entry['Directory']
+
+    def get_repos_with_FROM(self, FROM, depth=1):
+        """
+        Recursively go up the chain of turtles until an os image is found
+        (no repo), or an image that is provided, or one more than
+        --max-depth images up from the Dockerfile (depth is how far up FROM
+        is)
+        Returns the role names of the chain (closest parent first). Images
+        are only resolved when a chain gets to them, so nothing past where
+        the chains stop gets fetched
+        """
+        image = ''.join(FROM.split()[1:])
+        if self.max_depth is not None and depth > self.max_depth:
+            return self.stop_at(image, 'past --max-depth')
+        if self.is_provided(image):
+            return self.stop_at(image, 'provided')
+        role = self.resolve_image(image)
+        if role is None:
+            return []
+        return [role] + self.get_role_chain(role, depth)
+
+    def resolve_image(self, image):
+        """
+        Returns the role of image (None if it has no repo). Every image is
+        only resolved once, so chains shared by several Dockerfiles are
+        free, and not at all if the manifest still knows its role
+        Safe to call from several threads: an image that is being resolved
+        by another thread is waited on instead of being resolved again
+        """
+        with self.FROM_lock:
+            role = self.FROM_roles.get(image)
+            if role is None:
+                self.FROM_roles[image] = Future()
+        if role is not None:
+            return role.result()
+
+        try:
+            resolved = self.manifest.image(image)
+            if resolved is None:
+                role = self.resolve_FROM(image)
+                with self.FROM_lock:  # an image that couldn't be fetched
+                    failed = image in self.stopped_images  # is tried again
+                if not failed:
+                    self.manifest.record_image(image, role)
+            else:
+                role, needs = resolved
+                self.role_needs.update(needs)
+        except BaseException as e:
+            self.FROM_roles[image].set_exception(e)
+            raise
+        self.FROM_roles[image].set_result(role)
+        return role
+
+    def resolve_FROM(self, stripped_FROM):
+        """
+        Fetches the repo of the image (if it has one) and makes its Docker
+        object
+        Returns the role name of the image, None if it has no repo (or it
+        couldn't be fetched, then the chain stops at it)
+        """
+        repo, tags = split_image(stripped_FROM)
+        dirs = tags.split('-')
+        # Make a string to find the correct directory
+        dir_str = ''
+        version = ''
+        for _dir in dirs:
+            version += '_' + _dir
+            dir_str += '/' + _dir
+
+        # Keep fetching repos until it finds one that is an image
+        # Must be an image if there is no repo there
+        # Only the Directory of the tags is needed from the repo
+        # (unless the memory knows where it is and it's still there)
+        link = self.git_base + repo + '.git'
+        resolved = None
+        if self.memory is not None:
+            resolved = self.memory.images.get((link, tags, self.cache.sparse))
+        if resolved is not None and (resolved[1] is None or
+                                     os.path.isdir(resolved[1])):
+            lib_dir, repo_dir = resolved
+        else:
+            lib_dir = self.get_repo_dir_from_docker_lib(repo, tags)
+            repo_dir = None
+            if lib_dir is not None:
+                repo_dir = self.cache.fetch(link, lib_dir)
+            if self.memory is not None and (lib_dir is None or
+                                            repo_dir is not None):
+                self.memory.images.put((link, tags, self.cache.sparse),
+                                       (lib_dir, repo_dir))
+        if lib_dir is None:
+            logger.info('Docker used image:\n        ' + stripped_FROM)
+            return None
+        if repo_dir is None:  # in the library, but not fetched
+            logger.warning('Could not fetch ' + link + ' for ' +
+                           stripped_FROM + (' (not in the cache)'
+                                            if self.cache.offline else ''))
+            self.stop_at(stripped_FROM, 'could not be fetched')
+            return None
+
+        dir_str = '/' + lib_dir
+
+        # instantiate a new Docker object, its tasks copy the staged files
+        # (which are looked up in the cache, where they come from)
+        role = repo + version
+        docker_file = repo_dir + dir_str + '/Dockerfile'
+        self.load_docker(docker_file, self.dependencies_name + repo + dir_str,
+                         role, repo_dir + dir_str)
+        self.dependencies_copy(repo, repo_dir, dir_str,
+                               self.docker_files.get(role))
+        return role
+
+    def get_role_chain(self, role, depth=0):
+        """
+        Returns the role names that a role made by load_docker needs
+        (closest first): the roles of the stages it's built on or copies
+        from (and what they need), then the chains of its images. depth is
+        how many images up from the Dockerfile role is
+        """
+        images, stage_roles = self.role_needs[role]
+        chain = []
+        for stage_role in stage_roles:
+            chain += [stage_role] + self.get_role_chain(stage_role, depth)
+        for image in images:
+            if image != 'scratch':  # empty image, nothing to resolve
+                chain += self.get_repos_with_FROM('FROM ' + image, depth + 1)
+        return chain
+
+    def is_provided(self, image):
+        """
+        Returns true if image matches one of the --provided images (repo,
+        repo:tag or a glob of them)
+        """
+        repo, tag = split_image(image)
+        for pattern in self.provided:
+            if (fnmatch.fnmatchcase(repo, pattern) or
+                    fnmatch.fnmatchcase(repo + ':' + tag, pattern)):
+                return True
+        return False
+
+    def stop_at(self, image, reason):
+        """
+        Remembers that a chain stopped at image (without resolving it)
+        Returns the (empty) rest of the chain
+        """
+        with self.FROM_lock:
+            self.stopped_images[image] = reason
+        return []
+
+    def load_docker(self, file_name, dir_str, role, context_dir=None):
+        """
+        Makes the Docker objects of role (the last stage of the Dockerfile)
+        and of the stages it needs (role_<stage name>), unless the manifest
+        says their tasks files are already up to date with the Dockerfile
+        What each role needs goes in role_needs
+        context_dir is where the files of dir_str are now (dir_str itself
+        by default)
+        """
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        tokens = None
+        if self.memory is not None:
+            content_hash = hashlib.sha256(content).hexdigest()
+            tokens = self.memory.dockerfiles.get(content_hash)
+        docker = srcs = None
+        if copy_regex.search(content):  # the digest has the paths it uses
+            docker = self.make_docker(file_name, dir_str, tokens=tokens,
+                                      context_dir=context_dir)
+            srcs = docker.referenced_files()
+        digest = Manifest.digest(content, dir_str,
+                                 self.get_context(context_dir or dir_str),
+                                 srcs)
+        if not (self.stdout and role == self.output_role):
+            needs = self.manifest.needs(role, digest)
+            if needs is not None:
+                self.role_needs.update(needs)
+                return
+
+        if docker is None:
+            docker = self.make_docker(file_name, dir_str, tokens=tokens,
+                                      context_dir=context_dir)
+        if self.memory is not None and tokens is None:
+            self.memory.dockerfiles.put(content_hash, docker.tokens)
+        stage_roles = {docker.stage: role}
+        for stage in docker.needed_stages():
+            stage_roles[stage] = role + '_' + docker.stages[stage].name
+        for stage, stage_role in stage_roles.items():
+            if stage != docker.stage:
+                self.docker_files[stage_role] = self.make_docker(
+                    file_name, dir_str, stage, docker.tokens, context_dir)
+            else:
+                self.docker_files[stage_role] = docker
+            self.docker_files[stage_role].digest = digest
+            self.docker_files[stage_role].role = stage_role
+            if stage >= 0:
+                self.role_needs[stage_role] = [
+                    docker.stages[stage].images,
+                    [stage_roles[other]
+                     for other in docker.stages[stage].stages]]
+            else:  # no FROM at all
+                self.role_needs[stage_role] = [[], []]
+
+    def make_docker(self, file_name, dir_str, stage=None, tokens=None,
+                    context_dir=None):
+        """
+        Returns the Docker object of a stage of a Dockerfile with the
+        options of the conversion
+        """
+        return Docker(file_name, dir_str, stage, self.native_packages,
+                      self.stats, tokens,
+                      self.get_context(context_dir or dir_str),
+                      self.synchronize, self.script_threshold,
+                      self.idempotent, self.env_file)
+
+    def get_context(self, context_dir):
+        """
+        Returns the BuildContext of context_dir, which all the Docker
+        objects of its Dockerfiles (and stages) share
+        """
+        with self.contexts_lock:
+            context = self.contexts.get(context_dir)
+            if context is None:
+                context = self.contexts[context_dir] = BuildContext(
+                    context_dir, self.generated_paths())
+            return context
+
+    def generated_paths(self):
+        """
+        Returns the paths of everything a conversion writes (which aren't
+        part of a build context, even if the output dir is in it)
+        """
+        paths = [self.path(name) for name in (
+            'roles', 'site.yml', 'site_*.yml', 'ansible.cfg',
+            self.dependencies_name.rstrip('/'))]
+        return paths + [self.manifest_file, self.cache.cache_dir]
+
+    def make_ansible_config_file(self):
+        """
+        Makes a config file to make sure long commands don't time out the
+        ssh connection
+        """
+        write_file(self.path('ansible.cfg'),
+                   '[defaults]\n'
+                   'host_key_checking = False\n\n'
+                   '[ssh_connection]\n'
+                   'ssh_args = -o ServerAliveInterval=30 '
+                   '-o ServerAliveCountMax=30')
+
+    def make_ansible_role_file(self, tasks, file_name='site.yml'):
+        """
+        Creates a role file (site.yml) given all of the tasks
+        """
+        lines = ['---', '- hosts: all', '  become: yes', '  roles:']
         for task in tasks:
-            f.write('    - ' + task + '\n')
+            lines.append('    - ' + task)
+        write_file(self.path(file_name), '\n'.join(lines) + '\n')
 
 
-def remove_all_repos():
+def dir_size(path):
     """
-    Gets rid of all of the repos that were downloaded
+    Returns the total size of the files under path in bytes
     """
-    for repo in repos:
-        shutil.rmtree(repo)
-    shutil.rmtree('official-images')
+    size = 0
+    for root, _, files in os.walk(path):
+        for _file in files:
+            _file = os.path.join(root, _file)
+            if not os.path.islink(_file):
+                size += os.path.getsize(_file)
+    return size
 
 
-"""------------------------------------MAIN-----------------------------"""
-# command-line argument stuff
-# -i for input file
-# -o for output file
-desc = 'Convert a Dockerfile to Ansible code'
-argparser = argparse.ArgumentParser(description=desc)
-argparser.add_argument(
-    '-i', nargs=1, default=['Dockerfile'], type=str,
-    metavar='<input_file>',
-    help='The input (Dockerfile) file name; *Default: Dockerfile')
-argparser.add_argument(
-    '-o', nargs=1, default=['UnDockerized'], type=str,
-    metavar='<output_role>',
-    help='The output (Ansible) role name; *Default: UnDockerized')
-_help = ('*****USE WITH CAUTION!!!***** Will delete everything in the '
-         'UnDock_Dependencies folder, everything in the roles folder, and '
-         'the site.yml file.')
-argparser.add_argument(
-    '-c', '--clean', dest='clean', action='store_true', help=_help)
-_help = ("Won't convert any Dockerfile. Use in tandem with -c if you just "
-         "want to clean the workspace. Will run nothing if used alone (Why"
-         " would you want to do that? Maybe you like hitting enter in"
-         "terminal).")
-argparser.add_argument(
-    '-n', '--nobuild', dest='nobuild', action='store_true',
-    help=_help)
-args = vars(argparser.parse_args())
-
-input_file = args['i'][0]
-output_file = args['o'][0]
-clean = args['clean']
-nobuild = args['nobuild']
-
-dependencies_dir = 'UnDock_Dependencies/'
-if clean:
-    clean_workspace()
-if nobuild:
-    exit()
-
-docker_files = []  # Docker objects that are created
-repos = []  # Cloned Repo names
-repo_versions = []  # Versions to store for yml file names
-repo_tasks = []  # Ansible task names to be used for roles
-
-
-def main():
-    # Parse input Dockerfile
-    if os.path.isfile(input_file):
-        docker_files.append(Docker(input_file, '.'))
+def staged_names(sources, names):
+    """
+    Returns which of the names of the files next to a Dockerfile are used
+    by sources (see Docker.referenced_files): the ones sources name or
+    match as a glob, and the Dockerfile. All of them when sources is None
+    or copies the whole dir
+    """
+    if sources is None:
+        return set(names)
+    staged = {'Dockerfile'}
+    for src in sources:
+        src = os.path.normpath(src.lstrip('/'))
+        if src == '.':
+            return set(names)
+        if '/' not in src:  # only the files directly in the dir get staged
+            staged.update(fnmatch.filter(names, src))
+    return staged & set(names)
+
+
+def link_file(src, dest):
+    """
+    Puts src at dest sharing its data when the filesystem can: a reflink
+    (a copy on write clone), or else a hardlink, or else a copy
+    Returns how it got there: 'reflinked', 'linked' or 'copied'
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as src_f, open(dest, 'wb') as dest_f:
+                fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+            shutil.copystat(src, dest)
+            return 'reflinked'
+        except OSError:
+            os.remove(dest)
+    try:
+        os.link(src, dest)
+        return 'linked'
+    except OSError:
+        shutil.copy2(src, dest)
+        return 'copied'
+
+
+def get_batch_services(batch):
+    """
+    Returns (Dockerfile, role name, dependencies dir) for every service of a
+    batch. batch is either a directory that gets searched for Dockerfiles or
+    a manifest file with one "<Dockerfile> [<role>]" per line
+    """
+    services = []
+    if os.path.isdir(batch):
+        batch = os.path.normpath(batch)
+        for root, subdirs, files in os.walk(batch):
+            subdirs.sort()  # same order every run
+            if 'Dockerfile' in files:
+                rel_dir = os.path.relpath(root, batch)
+                if rel_dir == '.':
+                    rel_dir = os.path.basename(os.path.abspath(batch))
+                role = rel_dir.replace(os.sep, '_')
+                services.append((os.path.join(root, 'Dockerfile'), role, root))
     else:
-        print('File "' + input_file + '" does not exist. Exiting...')
-        exit()
+        manifest_dir = os.path.dirname(batch)
+        with open(batch, 'r') as f:
+            for line in f:
+                line_split = line.split()
+                if len(line_split) == 0 or line_split[0].startswith('#'):
+                    continue
+                file_name = os.path.join(manifest_dir, line_split[0])
+                _dir = os.path.dirname(file_name) or '.'
+                if len(line_split) > 1:
+                    role = line_split[1]
+                else:
+                    role = os.path.basename(os.path.abspath(_dir))
+                services.append((file_name, role, _dir))
+    return services
+
+
+def split_image(image):
+    """
+    Returns (repo, tag) of an image, the tag is latest if there is none.
+    Official images can be named library/<repo> or docker.io/library/<repo>
+    """
+    image = image.split('@')[0]  # pinned by digest
+    repo, colon, tag = image.rpartition(':')
+    if colon == '' or '/' in tag:
+        repo, tag = image, 'latest'
+    for prefix in ('docker.io/', 'library/'):
+        if repo.startswith(prefix):
+            repo = repo[len(prefix):]
+    return repo, tag
+
+
+def tasks_file_name(role, _format='yaml', output_dir='.'):
+    """
+    Returns the name of the tasks file of role
+    """
+    return os.path.join(output_dir, 'roles', role, 'tasks',
+                        'main.' + ('json' if _format == 'json' else 'yml'))
 
-    # Clone the official-images library
-    link = 'https://github.com/docker-library/official-images.git'
-    subprocess_call(['git', 'clone', link], stdout=PIPE, stderr=PIPE)
 
-    # Recursively get all the repos from FROM statements
-    get_repos_with_FROM(docker_files[0].FROM)
+def write_tasks(docker, file_name, role_dir, _format='yaml', atomic=False,
+                task_cache=None):
+    """
+    Streams the tasks of docker to the tasks file file_name, taking them
+    from the task cache if it has them (and saving them in it if it
+    doesn't), then writes the files its tasks need in role_dir
+    Returns (the name of the tasks file, the Stats report of the
+    conversion). Runs in the I/O threads and the parse processes
+    """
+    key = tasks = None
+    if task_cache is not None:
+        key = task_cache.key(docker)
+        tasks = task_cache.get(key)
+    with Ansible(file_name, atomic, _format, stats=docker.stats,
+                 record=key is not None and tasks is None) as ansible_file:
+        if tasks is None:
+            docker.parse_docker(ansible_file)
+        else:
+            for task in tasks:
+                ansible_file.append(task)
+    if ansible_file.tasks is not None:
+        task_cache.put(key, ansible_file.tasks)
+    write_role_files(role_dir, ansible_file.files)
+    return ansible_file.file_name, docker.stats.report()
+
+
+def write_role_files(role_dir, files):
+    """
+    Writes the files ({path in the role dir: content}) of a role, and
+    deletes the ones it made before that aren't in it anymore
+    """
+    for sub_dir in ('files', 'templates', 'defaults'):
+        if not os.path.isdir(os.path.join(role_dir, sub_dir)):
+            continue
+        for name in os.listdir(os.path.join(role_dir, sub_dir)):
+            path = sub_dir + '/' + name
+            if role_file_regex.match(path) and path not in files:
+                os.remove(os.path.join(role_dir, path))
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(role_dir, path)),
+                    exist_ok=True)
+        write_file(os.path.join(role_dir, path), content)
+
+
+# files of roles that tasks need (scripts of RUNs, the ENV file of
+# --env-file and its defaults)
+role_file_regex = re.compile(r'(files/run_[0-9]+_[0-9a-f]{10}\.sh'
+                             r'|templates/environment\.sh\.j2'
+                             r'|defaults/main\.yml)\Z')
+
+
+def write_file(file_name, content):
+    """
+    Writes content to file_name, unless the file already has it (so its
+    mtime only changes when it does)
+    """
+    try:
+        with open(file_name, 'r') as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+    with open(file_name, 'w') as f:
+        f.write(content)
+
+
+def convert(dockerfile=None, options=None, **kwargs):
+    """
+    Converts a Dockerfile to Ansible like the command line would, and
+    returns the Conversion (its tasks_files, site_files, stats...)
+    dockerfile is the path of the Dockerfile or its text (anything with a
+    newline in it), by default the input_file of the options
+    options are {long option name: value} (see default_options), which
+    keyword args override. Use a different output_dir for each of the
+    conversions that run at the same time
+    Raises UndockerizeError if the Dockerfile can't be converted
+    """
+    defaults = default_options()
+    options = dict(options or {}, **kwargs)
+    for option in options:
+        if option not in defaults:
+            raise UndockerizeError('Unknown option "' + option + '"')
+    options = dict(defaults, **options)
+    if dockerfile is None or '\n' not in dockerfile:
+        if dockerfile is not None:
+            options['input_file'] = dockerfile
+        return Conversion(options).run()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        service = write_dockerfile(dockerfile, tmp_dir,
+                                   options['output_role'])
+        options['input_file'] = service[0]
+        return Conversion(options).run([service])
+
+
+def write_dockerfile(dockerfile, tmp_dir, role):
+    """
+    Writes the text of a Dockerfile to tmp_dir
+    Returns its service for Conversion.run, with an empty build context
+    (it has no files, so COPYs from it must not find the ones of the cwd)
+    """
+    file_name = os.path.join(tmp_dir, 'Dockerfile')
+    with open(file_name, 'w') as f:
+        f.write(dockerfile)
+    context_dir = os.path.join(tmp_dir, 'context')
+    os.makedirs(context_dir)
+    return file_name, role, '.', context_dir
+
+
+def default_options():
+    """
+    Returns the options of a conversion when nothing is given on the
+    command line
+    """
+    return vars(make_argparser().parse_args([]))
+
+
+"""------------------------------------SERVE----------------------------"""
+
+
+class Server:
+    """
+    Server Class
+    ----------------------------------------
+    undockerize serve: converts the Dockerfiles POSTed to /convert (over
+    HTTP or a unix socket) with one Memory for all of them, and returns
+    the roles as a .tar.gz. GET /metrics has the counts of the requests
+    and the hits and misses of the Memory
+    """
+    # Options that a request can set in its query string (the rest are the
+    # ones the server was started with)
+    request_options = ('output_role', 'format', 'coalesce_runs',
+                       'native_packages', 'max_depth', 'provided', 'atomic')
+
+    def __init__(self, options):
+        """
+        Instantiates Server object
+        options are the options of every conversion (and of serve)
+        """
+        self.options = dict(options, stats=True, clean=False, nobuild=False,
+                            batch=None, stdout=False)
+        self.memory = Memory(options['memory_size'], options['cache_ttl'])
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        # The stats counters of every conversion added up
+        self.counters = {}
+
+    def convert(self, dockerfile, query=''):
+        """
+        Converts the text of a Dockerfile with the options in query
+        Returns the roles, site.yml, ansible.cfg and UnDock_Dependencies as
+        a .tar.gz
+        Raises UndockerizeError if the request is bad or it can't be
+        converted
+        """
+        start = time.perf_counter()
+        with self.lock:
+            self.requests += 1
+        try:
+            options = self.parse_query(query)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output_dir = os.path.join(tmp_dir, 'out')
+                service = write_dockerfile(dockerfile, tmp_dir,
+                                           options['output_role'])
+                options['input_file'] = service[0]
+                options['output_dir'] = output_dir
+                conversion = Conversion(options, self.memory).run([service])
+                archive = io.BytesIO()
+                with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+                    for name in sorted(os.listdir(output_dir)):
+                        if name != os.path.basename(conversion.manifest_file):
+                            tar.add(os.path.join(output_dir, name), name)
+        except BaseException:
+            with self.lock:
+                self.errors += 1
+            raise
+        with self.lock:
+            self.seconds += time.perf_counter() - start
+            for name, count in conversion.stats.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + count
+        return archive.getvalue()
+
+    def parse_query(self, query):
+        """
+        Returns the options of a conversion with the ones in query
+        Raises UndockerizeError if one of them can't be set by a request
+        """
+        options = dict(self.options)
+        for key, values in urllib.parse.parse_qs(query).items():
+            if key not in self.request_options:
+                raise UndockerizeError('Unknown option "' + key + '"')
+            value = values[-1]
+            if key == 'provided':
+                options[key] = self.options[key] + values
+            elif isinstance(self.options[key], bool):
+                options[key] = value.lower() in ('1', 'true', 'yes', 'on')
+            elif key == 'max_depth':
+                if not value.isdigit():
+                    raise UndockerizeError('max_depth has to be a number')
+                options[key] = int(value)
+            elif key == 'format' and value not in ('yaml', 'json'):
+                raise UndockerizeError('format has to be yaml or json')
+            elif (key == 'output_role' and
+                    re.match(r'[a-zA-Z0-9_][a-zA-Z0-9_.-]*$', value) is None):
+                raise UndockerizeError('Bad output_role "' + value + '"')
+            else:
+                options[key] = value
+        return options
+
+    def metrics(self):
+        """
+        Returns the metrics of the server as a dict
+        """
+        with self.lock:
+            return {'uptime': time.time() - self.start,
+                    'requests': self.requests, 'errors': self.errors,
+                    'seconds': self.seconds,
+                    'counters': dict(self.counters),
+                    'memory': self.memory.metrics()}
+
+    def make_http_server(self, listen=None, socket_path=None):
+        """
+        Returns the HTTP server on listen (host:port), or on a unix socket
+        at socket_path. Each request gets its own thread
+        """
+        if socket_path is not None:
+            if os.path.exists(socket_path):  # left by a server that died
+                os.remove(socket_path)
+            httpd = UnixHTTPServer(socket_path, ServeHandler)
+        else:
+            host, _, port = listen.rpartition(':')
+            httpd = http.server.ThreadingHTTPServer((host, int(port)),
+                                                    ServeHandler)
+        httpd.undockerize = self
+        return httpd
 
-    # Write all of the ansible files
-    for x in range(0, len(docker_files)):
-        docker_file = docker_files[x]
-        docker_file.parse_docker()
-        ansible_file = Ansible(
-            docker_file.ansible_file, docker_file.all_env_vars)
 
-        # Location and file name
-        if x == 0:
-            repo_tasks.append(output_file)
-            file_name = 'roles/' + output_file + '/tasks/main'
+class ServeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    ServeHandler Class
+    ----------------------------------------
+    Handles the requests of undockerize serve (self.server.undockerize is
+    the Server)
+    """
+    def do_GET(self):
+        """
+        GET /metrics
+        """
+        if urllib.parse.urlsplit(self.path).path != '/metrics':
+            self.reply(404, 'Not found')
+            return
+        metrics = self.server.undockerize.metrics()
+        self.reply(200, json.dumps(metrics, indent=1, sort_keys=True),
+                   'application/json')
+
+    def do_POST(self):
+        """
+        POST /convert?<options> with the Dockerfile as the body
+        """
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/convert':
+            self.reply(404, 'Not found')
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            dockerfile = self.rfile.read(length).decode('utf-8')
+            archive = self.server.undockerize.convert(dockerfile, url.query)
+        except (UndockerizeError, UnicodeDecodeError) as e:
+            self.reply(400, str(e))
+        except Exception as e:
+            self.reply(500, 'Conversion failed: ' + repr(e))
         else:
-            # x-1: input not included (docker_files[0])
-            repo_task = repos[x-1] + repo_versions[x-1]
-            repo_tasks.append(repo_task)
-            file_name = 'roles/' + repo_task + '/tasks/main'
+            self.reply(200, archive, 'application/gzip')
+
+    def reply(self, code, body, content_type='text/plain; charset=utf-8'):
+        """
+        Sends the response (body is bytes, or a str that gets a new line)
+        """
+        if isinstance(body, str):
+            body = (body + '\n').encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        """
+        Returns the client for the log (unix socket clients have no address)
+        """
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """
+    UnixHTTPServer Class
+    ----------------------------------------
+    ThreadingHTTPServer on a unix socket
+    """
+    daemon_threads = True
 
-        ansible_file.write_to_file(file_name)
 
-    # Want roles above this line to run in reverse order
-    repo_tasks.reverse()
+def serve(argv=None):
+    """
+    Runs undockerize serve until it's interrupted
+    """
+    argparser = make_argparser()
+    argparser.prog += ' serve'
+    argparser.description = (
+        'Convert the Dockerfiles POSTed to /convert and return their roles '
+        'as a .tar.gz, keeping the library index, resolved images and '
+        'parsed Dockerfiles in memory. The options are the defaults of '
+        'every request')
+    argparser.add_argument(
+        '--listen', dest='listen', default='127.0.0.1:8080', type=str,
+        metavar='<host:port>',
+        help='Where to listen for HTTP requests; *Default: 127.0.0.1:8080')
+    argparser.add_argument(
+        '--socket', dest='socket', default=None, type=str, metavar='<path>',
+        help='Listen on a unix socket at <path> instead')
+    argparser.add_argument(
+        '--memory-size', dest='memory_size', default=256, type=int,
+        metavar='<entries>',
+        help='How many library indexes, resolved images and parsed '
+             'Dockerfiles are kept in memory (each, the least recently used '
+             'ones are dropped); *Default: 256')
+    options = vars(argparser.parse_args(argv))
+
+    log_to_stdout()
+    httpd = Server(options).make_http_server(options['listen'],
+                                             options['socket'])
+    print('Listening on ' + (options['socket'] or options['listen']))
+    # Stop the same way for a kill as for ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if options['socket'] is not None and os.path.exists(options['socket']):
+            os.remove(options['socket'])
 
-    # Make the site file
-    make_ansible_role_file(repo_tasks)
 
-    # Generates the ansible.cfg file for ssh timeout
-    make_ansible_config_file()
+"""------------------------------------MAIN-----------------------------"""
+
 
-    # Get rid of all the cloned git repos
-    remove_all_repos()
+def make_argparser():
+    """
+    Returns the parser of the command line options
+    """
+    # command-line argument stuff
+    # -i for input file
+    # -o for output file
+    desc = 'Convert a Dockerfile to Ansible code'
+    argparser = argparse.ArgumentParser(description=desc)
+    argparser.add_argument(
+        '-i', dest='input_file', default='Dockerfile', type=str,
+        metavar='<input_file>',
+        help='The input (Dockerfile) file name; *Default: Dockerfile')
+    argparser.add_argument(
+        '-o', dest='output_role', default='UnDockerized', type=str,
+        metavar='<output_role>',
+        help='The output (Ansible) role name; *Default: UnDockerized')
+    argparser.add_argument(
+        '--output-dir', dest='output_dir', default='.', type=str,
+        metavar='<dir>',
+        help='Where the roles, site file(s), ansible.cfg, '
+             'UnDock_Dependencies and the manifest go; *Default: .')
+    _help = ('*****USE WITH CAUTION!!!***** Will delete everything in the '
+             'UnDock_Dependencies folder, everything in the roles folder, the '
+             'site.yml file and the .undockerize.json manifest (so every role '
+             'gets generated again).')
+    argparser.add_argument(
+        '-c', '--clean', dest='clean', action='store_true', help=_help)
+    _help = ("Won't convert any Dockerfile. Use in tandem with -c if you just "
+             "want to clean the workspace. Will run nothing if used alone (Why"
+             " would you want to do that? Maybe you like hitting enter in"
+             "terminal).")
+    argparser.add_argument(
+        '-n', '--nobuild', dest='nobuild', action='store_true',
+        help=_help)
+    _help = ('Convert every Dockerfile found under <batch> (or listed in the '
+             '<batch> manifest file as "<Dockerfile> [<role>]" lines) in one '
+             'run. Base images shared by the Dockerfiles only get one role, '
+             'and each service gets its own site_<role>.yml. Ignores -i and '
+             '-o')
+    argparser.add_argument(
+        '-b', '--batch', dest='batch', default=None, type=str,
+        metavar='<batch>', help=_help)
+    argparser.add_argument(
+        '--stdout', dest='stdout', action='store_true',
+        help='Write the tasks of the input Dockerfile to stdout instead of '
+             'its role (everything else that is printed goes to stderr)')
+    argparser.add_argument(
+        '--coalesce-runs', dest='coalesce_runs', action='store_true',
+        help='Merge consecutive RUN instructions into one shell task, so '
+             'ansible needs fewer ssh round trips')
+    argparser.add_argument(
+        '--native-packages', dest='native_packages', action='store_true',
+        help='Turn RUNs that only install packages with apt-get, yum, dnf, '
+             'apk or pip into the ansible modules for them (so packages that '
+             'are already installed get skipped)')
+    argparser.add_argument(
+        '--script-threshold', dest='script_threshold', default=None,
+        type=int, metavar='<chars>',
+        help='Put RUNs of at least this many characters (and RUNs with '
+             'heredocs) in scripts in the files dir of the role, which the '
+             'script module skips once they have succeeded')
+    argparser.add_argument(
+        '--idempotent', dest='idempotent', action='store_true',
+        help='Make the shell tasks skip themselves once they have succeeded '
+             '(creates), so running the playbook again does next to '
+             'nothing, and WORKDIRs file tasks')
+    argparser.add_argument(
+        '--env-file', dest='env_file', action='store_true',
+        help='Put the ENV vars of each role in /etc/profile.d/<role>.sh with '
+             'one template task (their values are the <role>_environment '
+             'default of the role) instead of a lineinfile task per ENV')
+    argparser.add_argument(
+        '--format', dest='format', default='yaml', choices=['yaml', 'json'],
+        help='yaml: main.yml tasks files, json: main.json tasks files (that '
+             'other tools can read without a YAML parser); *Default: yaml')
+    argparser.add_argument(
+        '--atomic', dest='atomic', action='store_true',
+        help='Write each tasks file to a temp file and rename it into place, '
+             'so a file is never seen half written')
+    argparser.add_argument(
+        '--max-depth', dest='max_depth', default=None, type=int,
+        metavar='<depth>',
+        help='Only follow the FROM chains this many images up from the '
+             'Dockerfile (0: only the Dockerfile). The images past that are '
+             'never fetched and have to be on the hosts already; '
+             '*Default: no limit')
+    argparser.add_argument(
+        '--provided', dest='provided', action='append', default=[],
+        metavar='<image>',
+        help='An image that the hosts already have (repo, repo:tag or a glob '
+             'like buildpack-deps:*), so the FROM chains stop there. Can be '
+             'given more than once')
+    argparser.add_argument(
+        '--stats', dest='stats', action='store_true',
+        help='Print how long fetching, copying, parsing, handling each '
+             'instruction and writing took (and how often they happened)')
+    argparser.add_argument(
+        '--stats-json', dest='stats_json', default=None, type=str,
+        metavar='<file>',
+        help='Write the --stats timers and counters to <file> as JSON')
+    argparser.add_argument(
+        '--profile', dest='profile', default=None, type=str, metavar='<file>',
+        help='Run under cProfile and write its stats to <file> (for python '
+             '-m pstats). Only the main thread is profiled')
+    argparser.add_argument(
+        '-j', '--jobs', dest='jobs', default=4, type=int, metavar='<jobs>',
+        help='How many repos can be fetched (and roles converted) at '
+             'the same time; *Default: 4')
+    argparser.add_argument(
+        '--parse-jobs', dest='parse_jobs', default=1, type=int,
+        metavar='<processes>',
+        help='How many processes convert Dockerfiles at the same time (1 '
+             'converts them in this one); *Default: 1')
+    _default_cache = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'undockerize')
+    argparser.add_argument(
+        '--cache-dir', dest='cache_dir', default=_default_cache, type=str,
+        metavar='<dir>',
+        help='Where fetched repos are kept between runs; *Default: ' +
+             _default_cache)
+    argparser.add_argument(
+        '--cache-ttl', dest='cache_ttl', default=86400, type=int,
+        metavar='<seconds>',
+        help='How long a cached repo is used before it is updated; '
+             '*Default: 86400')
+    argparser.add_argument(
+        '--cache-size', dest='cache_size', default=1024, type=int,
+        metavar='<MB>',
+        help='Least recently used repos are deleted from the cache when it '
+             'grows bigger than this; *Default: 1024')
+    argparser.add_argument(
+        '--tasks-cache-size', dest='tasks_cache_size', default=64, type=int,
+        metavar='<MB>',
+        help='Least recently used converted Dockerfiles are deleted from the '
+             'cache when their tasks grow bigger than this; *Default: 64')
+    argparser.add_argument(
+        '--no-cache', dest='no_cache', action='store_true',
+        help='Parse every Dockerfile again instead of using the tasks they '
+             'were converted to before (repos are still cached)')
+    argparser.add_argument(
+        '--fetch', dest='fetch', default='sparse', choices=['sparse', 'full'],
+        help='sparse: shallow clones that only check out the Directory of '
+             'each image, full: complete clones; *Default: sparse')
+    argparser.add_argument(
+        '--staging', dest='staging', default='copy', choices=['copy', 'link'],
+        help='copy: copy every file next to the Dockerfile of each image into '
+             'UnDock_Dependencies, link: only the ones its COPYs and ADDs '
+             'use, as reflinks (or hardlinks) of the cached files when the '
+             'filesystem can; *Default: copy')
+    argparser.add_argument(
+        '--synchronize', dest='synchronize', default=None, type=int,
+        metavar='<files>',
+        help='Copy the dirs that COPYs and ADDs use with the synchronize '
+             'module (rsync) when they have at least this many files, '
+             'instead of the copy module')
+    argparser.add_argument(
+        '--offline', dest='offline', action='store_true',
+        help="Only use repos that are already in the cache, don't fetch "
+             'anything')
+    argparser.add_argument(
+        '--git-base', dest='git_base',
+        default='https://github.com/docker-library/', type=str,
+        metavar='<url>',
+        help='Where the official-images and docker-library repos are cloned '
+             'from; *Default: https://github.com/docker-library/')
+    return argparser
+
+
+class CLIFormatter(logging.Formatter):
+    """
+    CLIFormatter Class
+    ----------------------------------------
+    Formats what a conversion logs the way the command line has always
+    printed it (only the warnings get a prefix)
+    """
+    def format(self, record):
+        message = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            return record.levelname + ': ' + message
+        return message
+
+
+def log_to_stdout():
+    """
+    Prints the messages of the undockerize logger (only the command line
+    does, library callers get them through logging)
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(CLIFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] == 'serve':
+        serve(argv[1:])
+        return
+    options = vars(make_argparser().parse_args(argv))
+    conversion = Conversion(options)
+
+    # Only the tasks go to stdout so that they can be piped
+    if conversion.stdout:
+        sys.stdout = sys.stderr
+    log_to_stdout()
+
+    profile_file = options['profile']
+    try:
+        if profile_file is None:
+            conversion.run()
+        else:  # only sees the main thread (not the fetches of the pool)
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(conversion.run)
+            finally:
+                profiler.dump_stats(profile_file)
+                print('Profile written to ' + profile_file +
+                      ' (python -m pstats ' + profile_file + ')')
+    except UndockerizeError as e:
+        print(str(e) + '. Exiting...')
+        exit()
 
-    # print ansible command to run the generated code
-    print('ansible-playbook site.yml -u <user> -i <host>,')
+    stats = conversion.stats
+    if stats.enabled:
+        if options['stats']:
+            print('\n'.join(stats.summary()))
+        if options['stats_json'] is not None:
+            with open(options['stats_json'], 'w') as f:
+                json.dump(stats.report(), f, indent=1, sort_keys=True)
+                f.write('\n')
 
 
 if __name__ == '__main__':